@@ -0,0 +1,26 @@
+import os, shutil, contextlib
+
+def atomic_write(path, write, directory=False):
+    """Create path through write(f), f a binary file (or write(d), d a directory, with directory
+    set), under a per-process tmp name that is then renamed into place, so readers never see a
+    partial entry. The caches are optional: an OSError (a read-only or full disk, or another
+    process renaming its entry first) is returned instead of raised. The tmp name is removed."""
+    tmp = f'{path}.{os.getpid()}.tmp'
+    try:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        if directory:
+            os.makedirs(tmp, exist_ok=True)
+            write(tmp)
+        else:
+            with open(tmp, 'wb') as fout:
+                write(fout)
+        os.replace(tmp, path)
+    except OSError as e:
+        return e
+    finally:
+        with contextlib.suppress(OSError):
+            if os.path.isdir(tmp):
+                shutil.rmtree(tmp)
+            elif os.path.lexists(tmp):
+                os.remove(tmp)
+    return None
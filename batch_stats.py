@@ -0,0 +1,40 @@
+import functools
+import numpy as np
+from scipy.stats import chi2, fisher_exact
+
+
+def cmh_pvalues(tables, shift_zeros=True) :
+    """Mantel-Haenszel test of a common odds ratio of 1 for many stratified tables at once.
+    tables has shape (..., strata, 2, 2); strata without any count are left out, and strata
+    with a zero cell get 0.5 added to every cell when shift_zeros is set, as in statsmodels'
+    StratifiedTable(tables, shift_zeros=True).test_null_odds(). Returns (statistics, pvalues);
+    tables without any non-empty stratum get a statistic of 0 and a p-value of 1."""
+    tables = np.asarray(tables, dtype=np.float64)
+    used = tables.sum((-2, -1)) > 0
+    if shift_zeros :
+        tables = tables + 0.5 * (used & (tables == 0).any((-2, -1)))[..., None, None]
+    a, b, c, d = tables[..., 0, 0], tables[..., 0, 1], tables[..., 1, 0], tables[..., 1, 1]
+    apb, apc, bpd, cpd = a + b, a + c, b + d, c + d
+    n = apb + cpd
+    with np.errstate(divide='ignore', invalid='ignore') :
+        num = np.where(used, a - apb * apc / n, 0.).sum(-1)
+        var = np.where(used, apb * apc * bpd * cpd / (n**2 * (n - 1)), 0.).sum(-1)
+        statistic = num**2 / var
+    # 1 - cdf rather than sf, to rank nodes exactly like statsmodels does
+    pvalue = 1 - chi2.cdf(statistic, 1)
+    empty = ~used.any(-1)
+    statistic[empty] = 0.
+    pvalue[empty] = 1.
+    return statistic, pvalue
+
+
+@functools.lru_cache(maxsize=None)
+def _fisher(table) :
+    res = fisher_exact(table)
+    return res[1] if isinstance(res, tuple) else res
+
+
+def fisher_pvalue(table) :
+    """fisher_exact p-value of a count table, memoized on the table since many nodes
+    of a tree share identical counts"""
+    return _fisher(tuple(map(tuple, np.asarray(table).tolist())))
@@ -0,0 +1,179 @@
+import os, sys, gc, json, time, platform, tempfile, tracemalloc
+import numpy as np
+import pandas as pd
+import click
+from nwk_tree import load_tree
+from sample_metadata import load_metadata
+from pair_category import encode_metadata, categorize_pairs
+from brayCurtis import read_profile, distance_blocks
+import strainSharing, individual_strain_tracking, individual_lineage_tracking
+
+COHORTS = ('rCDI', 'IBS', 'LUAD', 'MEL')
+DAYS = (0, 7, 14, 30, 60, 90)
+
+def synthetic_metadata(n_samples, rng, donor_fraction=0.25):
+    """Metadata of n_samples samples in the layout the scripts read. Cohorts take turns adding
+    an individual: a healthy donor sampled on 1-3 days, or a patient of one of the cohort's
+    donors, sampled before FMT on day 0 and then 1-3 times as a (non-)responder."""
+    rows, donors = [], {c: [] for c in COHORTS}
+    while len(rows) < n_samples:
+        cohort = COHORTS[len(rows) % len(COHORTS)]
+        name = f'{cohort}_{len(rows)}'
+        days = np.sort(rng.choice(DAYS[1:], rng.integers(1, 4), replace=False)).tolist()
+        if not donors[cohort] or rng.random() < donor_fraction:
+            donors[cohort].append(name)
+            rows.extend((cohort, name, name, day, 'healthy') for day in [0] + days[:-1])
+        else:
+            donor = donors[cohort][rng.integers(len(donors[cohort]))]
+            outcome = 'responder' if rng.random() < 0.6 else 'non-responder'
+            rows.append((cohort, name, donor, 0, 'before_FMT'))
+            rows.extend((cohort, name, donor, day, outcome) for day in days)
+    meta = pd.DataFrame(rows[:n_samples], columns=['Cohort', 'individual', 'donor', 'Day', 'Disease type'])
+    meta.insert(0, 'Sample_ID', [f'X{k}' for k in range(len(meta))])
+    meta.insert(0, 'ID', [f'S{k}' for k in range(len(meta))])
+    return meta
+
+def synthetic_newick(meta, n_tips, rng, mix=0.2, low_qual=0.3, references=0.05, branch_length=1e-3):
+    """Random Newick tree of n_tips leaves named 'sample|contig[|low_qual]' (and some reference
+    genomes). Leaves are ordered by individual, except for a mix fraction of them moved at
+    random, and adjacent nodes are joined until one is left, so most clades are made of the
+    samples of one individual, as in strain trees. Branch lengths are exponential."""
+    tip_rows = rng.integers(len(meta), size=n_tips)
+    tip_rows = tip_rows[np.argsort(meta['individual'].to_numpy()[tip_rows], kind='stable')]
+    moved = np.flatnonzero(rng.random(n_tips) < mix)
+    tip_rows[moved] = tip_rows[rng.permutation(moved)]
+    ids = meta['ID'].to_numpy()
+    nodes = []
+    for k, (row, quality, reference, length) in enumerate(zip(tip_rows.tolist(), (rng.random(n_tips) < low_qual).tolist(),
+                                                              (rng.random(n_tips) < references).tolist(),
+                                                              rng.exponential(branch_length, n_tips).tolist())):
+        name = f'GCF_{k:09d}.1' if reference else f'{ids[row]}|contig{k}' + ('|low_qual' if quality else '')
+        nodes.append(f'{name}:{length:.6g}')
+    joins = rng.integers(0, np.arange(n_tips - 1, 0, -1))
+    for k, length in zip(joins.tolist(), rng.exponential(branch_length, max(n_tips - 1, 0)).tolist()):
+        nodes[k:k + 2] = [f'({nodes[k]},{nodes[k + 1]}):{length:.6g}']
+    return nodes[0].rsplit(':', 1)[0] + ';'
+
+def write_profile(path, sample_ids, n_species, density, rng, viruses=0.02):
+    """Profile file of n_species rows (RPKM, a density fraction of them non-zero) over
+    sample_ids, in the format read_profile expects; a fraction of the species are viruses"""
+    with open(path, 'w') as fout:
+        fout.write('\t'.join(['#Species(RPKM)'] + [f'/data/{s}/profile.txt' for s in sample_ids] + ['#Taxonomy']) + '\n')
+        for k in range(n_species):
+            values = np.where(rng.random(len(sample_ids)) < density, rng.lognormal(1., 1.5, len(sample_ids)), 0.)
+            domain = 'd__Viruses' if rng.random() < viruses else 'd__Bacteria'
+            cells = ['%.4f' % v if v else '0' for v in values.tolist()]
+            fout.write('\t'.join([f'sp{k}', str(int((values > 0).sum()))] + cells + [f'{domain};p__P{k % 7};s__sp{k}']) + '\n')
+
+def measure(func, repeat):
+    """Wall times of repeat runs of func, and the tracemalloc peak (bytes) of one more run"""
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return times, peak
+
+def bray_curtis(X, codes, block_size):
+    """The brayCurtis.py loop without a writer: distances and categories of every block"""
+    n_pairs = 0
+    for i, j, dists in distance_blocks(X, ('braycurtis', ), block_size):
+        n_pairs += len(categorize_pairs(codes, i, j))
+    return n_pairs
+
+def strain_sharing(meta, tree_path, threshold, prune):
+    """One tree through strainSharing as a run processes it: the worker's tree_pairs (tree
+    parsing included) and the per-pair accumulation, under --prune when prune is set"""
+    strainSharing.init_worker(meta, threshold if prune else None)
+    accumulator = strainSharing.PairAccumulator(len(meta), [threshold], sample_id=strainSharing.distinct_sample_ids(meta) if prune else None)
+    accumulator.add(*strainSharing.tree_pairs(tree_path))
+    return accumulator.result()
+
+def parse_list(value, cast=int):
+    return [cast(v) for v in value.split(',') if v.strip()]
+
+@click.command()
+@click.option('-o', '--output', default='benchmark.json', help='JSON file of the results')
+@click.option('--tips', default='1000,5000,20000', help='Comma-separated tree sizes (leaves)')
+@click.option('--samples', default='200,1000', help='Comma-separated numbers of metadata / profile samples')
+@click.option('--species', default=2000, type=int, help='Species of the synthetic profiles')
+@click.option('--density', default=0.05, type=float, help='Fraction of non-zero profile abundances')
+@click.option('--threshold', default=0.001, type=float, help='Distance threshold of get_close_pairs')
+@click.option('--block-size', default=512, type=int, help='Block size of the Bray-Curtis loop')
+@click.option('-r', '--repeat', default=3, type=click.IntRange(1), help='Timed runs per benchmark (plus one run for the memory peak)')
+@click.option('-s', '--seed', default=0, type=int, help='Random seed of the synthetic data')
+@click.option('--only', default=None, help='Comma-separated benchmark names (or prefixes) to run')
+@click.option('--data-dir', default=None, help='Keep the synthetic files in this directory instead of a temporary one')
+@click.option('--compare', default=None, help='Earlier JSON output; prints the ratio of the best times')
+def main(output, tips, samples, species, density, threshold, block_size, repeat, seed, only, data_dir, compare):
+    """Time and memory-profile the core functions on synthetic trees, metadata and profiles"""
+    selected = parse_list(only, str) if only else None
+    rng = np.random.default_rng(seed)
+    results = []
+
+    def run(name, params, func):
+        if selected and not any(name.startswith(s) for s in selected):
+            return
+        times, peak = measure(func, repeat)
+        results.append({'benchmark': name, 'params': params, 'seconds': times, 'best': min(times),
+                        'median': float(np.median(times)), 'peak_bytes': peak})
+        print(f'{name} {json.dumps(params)}\tbest {min(times):.3f}s\tpeak {peak / 2**20:.1f} MiB', file=sys.stderr)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        data_dir = data_dir or tmp
+        os.makedirs(data_dir, exist_ok=True)
+        for n_samples in parse_list(samples):
+            meta_path = os.path.join(data_dir, f'meta_{n_samples}.tsv')
+            frame = synthetic_metadata(n_samples, rng)
+            frame.to_csv(meta_path, sep='\t', index=False)
+            run('load_metadata', {'samples': n_samples}, lambda: load_metadata(meta_path, cache=False))
+            meta = load_metadata(meta_path, cache=False)
+
+            profile_path = os.path.join(data_dir, f'profile_{n_samples}.tsv')
+            write_profile(profile_path, frame['ID'].tolist(), species, density, rng)
+            params = {'samples': n_samples, 'species': species, 'density': density}
+            for layout in ('dense', 'auto'):
+                run(f'read_profile.{layout}', params, lambda: read_profile(profile_path, layout=layout))
+            X, sample_ids, _ = read_profile(profile_path, layout='auto')
+            codes = encode_metadata(meta, meta.rows(sample_ids))
+            run('bray_curtis', dict(params, block_size=block_size), lambda: bray_curtis(X, codes, block_size))
+
+            for n_tips in parse_list(tips):
+                tree_path = os.path.join(data_dir, f'tree_{n_samples}_{n_tips}.nwk')
+                with open(tree_path, 'w') as fout:
+                    fout.write(synthetic_newick(frame, n_tips, rng))
+                params = {'samples': n_samples, 'tips': n_tips}
+                run('parse_newick', params, lambda: load_tree(tree_path))
+                tre = load_tree(tree_path)
+                run('strainSharing.get_distance', params, lambda: strainSharing.get_distance(tre, meta))
+                run('strainSharing.get_close_pairs', dict(params, threshold=threshold), lambda: strainSharing.get_close_pairs(tre, meta, threshold))
+                # the whole per-tree path, as the kernels alone leave out the pair arrays and the accumulation
+                run('strainSharing.tree', dict(params, threshold=threshold), lambda: strain_sharing(meta, tree_path, threshold, False))
+                run('strainSharing.tree.prune', dict(params, threshold=threshold), lambda: strain_sharing(meta, tree_path, threshold, True))
+                run('individual_strain_tracking.get_distance', params, lambda: individual_strain_tracking.get_distance(tre, meta))
+                run('individual_lineage_tracking.get_optimal_cut', params, lambda: individual_lineage_tracking.get_optimal_cut(tre, meta))
+
+    report = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+              'numpy': np.__version__, 'platform': platform.platform(), 'seed': seed, 'repeat': repeat,
+              'results': results}
+    with open(output, 'w') as fout:
+        json.dump(report, fout, indent=1)
+
+    if compare:
+        with open(compare) as fin:
+            previous = {(r['benchmark'], json.dumps(r['params'], sort_keys=True)): r['best'] for r in json.load(fin)['results']}
+        for r in results:
+            key = (r['benchmark'], json.dumps(r['params'], sort_keys=True))
+            if key in previous:
+                print(f'{r["benchmark"]}\t{json.dumps(r["params"])}\t{r["best"] / previous[key]:.2f}x')
+
+if __name__ == '__main__':
+    main()
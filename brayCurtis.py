@@ -1,114 +1,399 @@
-import os
+import os, json, hashlib
 import numpy as np
 import pandas as pd
 import click
-from itertools import combinations
-from scipy.spatial.distance import braycurtis
+from concurrent.futures import ThreadPoolExecutor
+from scipy.spatial.distance import cdist
+from scipy import sparse as sp
+from pair_category import CATEGORIES, encode_metadata, categorize_pairs
+from atomic_write import atomic_write
+from sample_metadata import load_metadata
 
-def parse_profile(profile_path):
-    """Parse microbiome profile file into DataFrame"""
+def read_profile(profile_path, dtype='float64', layout='dense', density_cutoff=0.1, chunksize=20000):
+    """Read a profile file as (abundances, sample_ids, species), abundances being a
+    samples x species array of dtype. The file is tab-delimited, so names and taxonomies
+    may contain spaces; every row must have the header's fields plus the second column,
+    or a ValueError is raised. Rows are parsed in chunks by the pandas C engine, and
+    viruses are dropped with a vectorized mask on the taxonomy.
+    layout 'sparse' returns a CSR matrix instead, built from sparse chunks so memory follows
+    the non-zeros; 'auto' picks one of the two from the fraction of non-zeros in the first
+    chunk (sparse below density_cutoff) and reads the rest in that layout."""
     with open(profile_path, 'r') as f:
-        # Parse header to extract sample IDs
-        header = next(f).split()
-        sample_paths = header[1:-1]  # Skip "#Species(RPKM)" and "#Taxonomy"
-        sample_ids = [os.path.basename(os.path.dirname(p)) for p in sample_paths]
-        
-        # Read data into DataFrame
-        data = []
-        species_names = []
-        # taxonomies = []
-        
-        for line in f:
-            parts = line.strip().split()
-            if not parts:
+        header = f.readline().rstrip('\r\n').split('\t')
+    sample_paths = header[1:-1]  # Skip "#Species(RPKM)" and "#Taxonomy"
+    sample_ids = [os.path.basename(os.path.dirname(p)) for p in sample_paths]
+    n = len(sample_ids)
+
+    # species name, skipped second column, abundances, taxonomy (last column)
+    taxonomy = n + 2
+    blocks, species = [], []
+    try:
+        reader = pd.read_csv(profile_path, sep='\t', header=None, skiprows=1, names=list(range(taxonomy + 1)),
+                             dtype={c: (dtype if 2 <= c < taxonomy else str) for c in range(taxonomy + 1)},
+                             na_filter=False, chunksize=chunksize)
+        for chunk in reader:
+            # a short row leaves its taxonomy empty, if its abundances parse at all
+            short = (chunk[taxonomy] == '').to_numpy()
+            if short.any():
+                raise ValueError(f'{profile_path}: the row of {chunk[0].iloc[np.flatnonzero(short)[0]]} has fewer than {taxonomy + 1} fields')
+            keep = ~chunk[taxonomy].str.contains('d__Viruses', regex=False).to_numpy()
+            species.extend(chunk[0].to_numpy()[keep].tolist())
+            block = chunk[list(range(2, taxonomy))].to_numpy(dtype=dtype)[keep]
+            if not len(block):
                 continue
-            
-            # Extract species name, abundances, and taxonomy
-            taxonomy = parts[-1]
-            if taxonomy.find('d__Viruses') < 0 :
-                species_names.append(parts[0])
-                data.append([float(x) for x in parts[2:2+len(sample_ids)]])
-    
-    # Create DataFrame with samples as columns
-    df = pd.DataFrame(data, index=species_names, columns=sample_ids).T
-    return df
-
-def categorize_pair(row1, row2):
-    """Categorize sample pair based on metadata"""
-    type1 = row1['Disease type']
-    type2 = row2['Disease type']
-    
-    if type1 == 'healthy' and type2 == 'healthy':
-        if row1['individual'] == row2['individual']:
-            return 'healthy_same_individual'
-        return 'healthy_different_individuals'
-    
-    if type1 != 'healthy' and type2 != 'healthy':
-        if type1 != 'before_FMT' and type2 != 'before_FMT':
-            if row1['individual'] == row2['individual']:
-                return 'same_patients'
-            if row1['donor'] == row2['donor']:
-                return 'different_patients_same_donor'
-            if row1['donor'] != row2['donor']:
-                return 'different_patients'
-        elif row1['individual'] == row2['individual'] and (type1 != 'before_FMT' or type2 != 'before_FMT'):
-            if row1['Disease type'] == 'responder' or row2['Disease type'] == 'responder':
-                return 'before_after_FMT_same_responder'
-            elif row1['Disease type'] == 'non-responder' or row2['Disease type'] == 'non-responder':
-                return 'before_after_FMT_same_non_responder'
-            # return 'before_after_FMT_same_individual'
-    
-    # One healthy, one patient
-    if type1 != 'healthy':
-        patient, healthy = row1, row2
+            if layout == 'auto':
+                layout = 'sparse' if np.count_nonzero(block) < density_cutoff * block.size else 'dense'
+            blocks.append(block if layout == 'dense' else sp.csr_matrix(block))
+    except pd.errors.EmptyDataError:
+        # header only
+        pass
+    except pd.errors.ParserError as e:
+        raise ValueError(f'{profile_path}: rows must have {taxonomy + 1} tab-separated fields ({e})')
+    if not blocks:
+        abundances = np.empty((n, 0), dtype=dtype)
+        return (sp.csr_matrix(abundances) if layout == 'sparse' else abundances), sample_ids, []
+
+    if layout == 'sparse':
+        return sp.vstack(blocks, format='csr', dtype=dtype).T.tocsr(), sample_ids, species
+
+    abundances = np.empty((n, len(species)), dtype=dtype)
+    offset = 0
+    for block in blocks:
+        abundances[:, offset:offset + len(block)] = block.T
+        offset += len(block)
+    return abundances, sample_ids, species
+
+def load_profile(profile_path, dtype='float64', cache_dir=None, layout='dense', density_cutoff=0.1):
+    """read_profile, cached in cache_dir as memory-mappable .npy files (the array, or the
+    data/indices/indptr of a CSR matrix) with a JSON index sidecar of sample ids and species,
+    under a key of the path, mtime, size and reading options"""
+    if not cache_dir:
+        return read_profile(profile_path, dtype, layout, density_cutoff)
+
+    st = os.stat(profile_path)
+    # 'tsv' marks the tab-delimited parser, so caches of the former whitespace split are not reused
+    key = hashlib.sha1(f'{os.path.abspath(profile_path)}\0{st.st_mtime_ns}\0{st.st_size}\0{dtype}\0{layout}\0{density_cutoff}\0tsv'.encode()).hexdigest()
+    index_file = os.path.join(cache_dir, key + '.index.json')
+    if os.path.isfile(index_file):
+        try:
+            with open(index_file) as f:
+                index = json.load(f)
+            arrays = {name: np.load(os.path.join(cache_dir, f'{key}.{name}.npy'), mmap_mode='r') for name in index['arrays']}
+            if 'X' in arrays:
+                return arrays['X'], index['samples'], index['species']
+            return sp.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']), shape=index['shape']), index['samples'], index['species']
+        except (OSError, ValueError, KeyError):
+            pass
+
+    abundances, sample_ids, species = read_profile(profile_path, dtype, layout, density_cutoff)
+    if sp.issparse(abundances):
+        arrays = {'data': abundances.data, 'indices': abundances.indices, 'indptr': abundances.indptr}
     else:
-        patient, healthy = row2, row1
-    
-    if patient['donor'] == healthy['individual'] and patient['Disease type'] != 'before_FMT':
-        if patient['Disease type'] == 'responder':
-            return 'patient_vs_its_donor_responder'
-        elif patient['Disease type'] == 'non-responder':
-            return 'patient_vs_its_donor_non_responder'
-    
-    return 'other'  # Default category for unmatched pairs
+        arrays = {'X': abundances}
+    index = {'samples': sample_ids, 'species': species, 'shape': list(abundances.shape), 'arrays': list(arrays)}
+    # the index goes last: it is only written once all its arrays are in place
+    files = [(os.path.join(cache_dir, f'{key}.{name}.npy'), lambda f, a=a: np.save(f, a)) for name, a in arrays.items()]
+    files.append((index_file, lambda f: f.write(json.dumps(index).encode())))
+    for path, write in files:
+        if atomic_write(path, write) is not None:
+            # cache not writable
+            break
+    return abundances, sample_ids, species
+
+def parse_profile(profile_path, dtype='float64', cache_dir=None):
+    """Parse microbiome profile file into DataFrame"""
+    abundances, sample_ids, species = load_profile(profile_path, dtype, cache_dir)
+    return pd.DataFrame(abundances, index=sample_ids, columns=species, copy=False)
+
+# Output column of each metric of --metrics
+METRICS = {'braycurtis': 'BrayCurtis', 'jaccard': 'Jaccard', 'aitchison': 'Aitchison', 'hellinger': 'Hellinger'}
+
+def _cdist_rows(M, metric, block_size):
+    """Distances of rows r0..r1-1 of a dense matrix to rows r0..n-1, computed in column
+    tiles on a thread pool (cdist releases the GIL)"""
+    dtype = bool if metric == 'jaccard' else np.float64
+    def rows(r0, r1, executor):
+        n = len(M)
+        A = np.ascontiguousarray(M[r0:r1], dtype=dtype)
+        D = np.empty((r1 - r0, n - r0))
+        def tile(c0):
+            D[:, c0 - r0:c0 - r0 + block_size] = cdist(A, np.ascontiguousarray(M[c0:c0 + block_size], dtype=dtype), metric)
+        list(executor.map(tile, range(r0, n, block_size)))
+        return D
+    return rows
+
+def _sparse_braycurtis_rows(X):
+    """Bray-Curtis of non-negative CSR rows as 1 - 2 * sum(min(u, v)) / (sum(u) + sum(v)),
+    where the sum of minimums of a row with all others only visits the species columns of
+    its own non-zeros, so the work follows the number of shared non-zeros"""
+    X = sp.csr_matrix(X, dtype=np.float64)
+    cols = X.tocsc()
+    totals = np.asarray(X.sum(1)).reshape(-1)
+    def rows(r0, r1, executor):
+        n = X.shape[0]
+        D = np.empty((r1 - r0, n - r0))
+        for r in range(r0, r1):
+            species, values = X.indices[X.indptr[r]:X.indptr[r+1]], X.data[X.indptr[r]:X.indptr[r+1]]
+            starts, counts = cols.indptr[species], np.diff(cols.indptr)[species]
+            pos = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+            min_sum = np.bincount(cols.indices[pos], weights=np.minimum(cols.data[pos], np.repeat(values, counts)), minlength=n)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                D[r - r0] = 1. - 2. * min_sum[r0:] / (totals[r] + totals[r0:])
+        return D
+    return rows
+
+def _sparse_gram_rows(M, distance):
+    """Distances from the inner products of CSR rows: distance(G, sq_i, sq_j) with G the
+    block of M M^T and sq the squared row norms (counts of non-zeros for binary rows)"""
+    M = sp.csr_matrix(M, dtype=np.float64)
+    sq = np.asarray(M.multiply(M).sum(1)).reshape(-1)
+    def rows(r0, r1, executor):
+        G = (M[r0:r1] @ M[r0:].T).toarray()
+        return distance(G, sq[r0:r1, None], sq[None, r0:])
+    return rows
+
+def _jaccard(G, a, b):
+    union = a + b - G
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(union > 0, (union - G) / union, 0.)
+
+def _euclidean(G, a, b):
+    return np.sqrt(np.maximum(a + b - 2 * G, 0.))
+
+def metric_kernels(X, metrics, block_size=512, pseudocount=None):
+    """For each metric, (rows, (low, high)): rows(r0, r1, executor) gives the distances of
+    rows r0..r1-1 of X to rows r0..n-1, and (low, high) bounds the values. The normalization
+    of a metric (presence/absence, CLR, Hellinger transform) is done once here.
+    Aitchison uses CLR(x + pseudocount), by default with half the smallest non-zero abundance;
+    CLR rows are dense, so it densifies a sparse profile."""
+    is_sparse = sp.issparse(X)
+    kernels = {}
+    for metric in metrics:
+        if metric == 'braycurtis':
+            kernels[metric] = (_sparse_braycurtis_rows(X) if is_sparse else _cdist_rows(X, 'braycurtis', block_size)), (0., 1.)
+        elif metric == 'jaccard':
+            kernels[metric] = (_sparse_gram_rows(X > 0, _jaccard) if is_sparse else _cdist_rows(X > 0, 'jaccard', block_size)), (0., 1.)
+        elif metric == 'hellinger':
+            totals = np.asarray(X.sum(1), dtype=np.float64).reshape(-1, 1)
+            scale = np.divide(1., totals, out=np.zeros_like(totals), where=totals > 0)
+            if is_sparse:
+                kernels[metric] = _sparse_gram_rows(sp.csr_matrix(X.multiply(scale)).sqrt(), _euclidean), (0., np.sqrt(2.))
+            else:
+                kernels[metric] = _cdist_rows(np.sqrt(X * scale.astype(X.dtype)), 'euclidean', block_size), (0., np.sqrt(2.))
+        elif metric == 'aitchison':
+            dense = X.toarray() if is_sparse else np.asarray(X)
+            if pseudocount is None:
+                nonzero = dense[dense > 0]
+                pseudocount = nonzero.min() / 2. if len(nonzero) else 1.
+            clr = np.log(dense + dense.dtype.type(pseudocount))
+            clr -= clr.mean(1, keepdims=True)
+            # no distance exceeds the sum of the two largest row norms
+            norms = np.sort(np.sqrt((clr.astype(np.float64) ** 2).sum(1)))
+            kernels[metric] = _cdist_rows(clr, 'euclidean', block_size), (0., max(norms[-2:].sum(), 1e-12))
+        else:
+            raise ValueError(f'Unknown metric {metric}')
+    return kernels
+
+def distance_blocks(X, metrics=('braycurtis', ), block_size=512, threads=1, pseudocount=None, kernels=None):
+    """Yield (i, j, {metric: distance}) arrays for all row pairs i < j of X, in itertools.combinations
+    order. Rows are processed block by block, each block being compared with the remaining rows,
+    so memory stays at a few (block_size x samples) arrays whatever the number of pairs."""
+    n = X.shape[0]
+    kernels = kernels or metric_kernels(X, metrics, block_size, pseudocount)
+    with ThreadPoolExecutor(max(threads, 1)) as executor:
+        for r0 in range(0, n - 1, block_size):
+            r1 = min(r0 + block_size, n)
+            i, j = np.triu_indices(r1 - r0, k=1, m=n - r0)
+            yield i + r0, j + r0, {metric: rows(r0, r1, executor)[i, j] for metric, (rows, bounds) in kernels.items()}
+
+class TsvWriter(object):
+    """Pairs as TSV rows: Sample1, Sample2, one column per distance, Category"""
+    def __init__(self, output, samples, columns):
+        self.samples, self.columns = samples, columns
+        self.fout = open(output, 'w')
+        self.fout.write('\t'.join(['Sample1', 'Sample2'] + columns + ['Category']) + '\n')
+
+    def write(self, i, j, category, values):
+        block = pd.DataFrame({'Sample1': self.samples[i], 'Sample2': self.samples[j]})
+        for column in self.columns:
+            block[column] = values[column]
+        block['Category'] = np.array(CATEGORIES, dtype=object)[category]
+        block.to_csv(self.fout, sep='\t', index=False, header=False)
+
+    def close(self):
+        self.fout.close()
+
+class NpyWriter(object):
+    """Condensed vectors (pairs in itertools.combinations order, as scipy's squareform) written
+    into memory-mapped .npy files: the distances go to output (output.<column>.npy with several
+    distance columns), category codes to <output>.category.npy, and the sample order and
+    category names to <output>.index.json"""
+    def __init__(self, output, samples, columns):
+        base = output[:-4] if output.endswith('.npy') else output
+        n_pairs = len(samples) * (len(samples) - 1) // 2
+        paths = {columns[0]: output} if len(columns) == 1 else {c: f'{base}.{c}.npy' for c in columns}
+        self.arrays = {c: np.lib.format.open_memmap(path, mode='w+', dtype=np.float64, shape=(n_pairs, )) for c, path in paths.items()}
+        self.category = np.lib.format.open_memmap(f'{base}.category.npy', mode='w+', dtype=np.int8, shape=(n_pairs, ))
+        with open(f'{base}.index.json', 'w') as f:
+            json.dump({'samples': samples.tolist(), 'categories': CATEGORIES, 'columns': paths}, f)
+        self.offset = 0
+
+    def write(self, i, j, category, values):
+        end = self.offset + len(i)
+        for column, array in self.arrays.items():
+            array[self.offset:end] = values[column]
+        self.category[self.offset:end] = category
+        self.offset = end
+
+    def close(self):
+        for array in list(self.arrays.values()) + [self.category]:
+            array.flush()
+
+class ParquetWriter(object):
+    """Pairs as Parquet row groups, one per block; sample and category columns are
+    dictionary-encoded against the sample list and CATEGORIES"""
+    def __init__(self, output, samples, columns):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise click.ClickException('--format parquet needs pyarrow')
+        self.pa, self.columns = pa, columns
+        self.samples, self.categories = pa.array(samples.tolist(), pa.string()), pa.array(CATEGORIES, pa.string())
+        schema = pa.schema([('Sample1', pa.dictionary(pa.int32(), pa.string())), ('Sample2', pa.dictionary(pa.int32(), pa.string()))]
+                           + [(c, pa.float64()) for c in columns] + [('Category', pa.dictionary(pa.int8(), pa.string()))])
+        self.writer = pq.ParquetWriter(output, schema)
+
+    def write(self, i, j, category, values):
+        pa = self.pa
+        arrays = [pa.DictionaryArray.from_arrays(pa.array(i, pa.int32()), self.samples),
+                  pa.DictionaryArray.from_arrays(pa.array(j, pa.int32()), self.samples)]
+        arrays += [pa.array(values[c], pa.float64()) for c in self.columns]
+        arrays.append(pa.DictionaryArray.from_arrays(pa.array(category, pa.int8()), self.categories))
+        self.writer.write_table(pa.Table.from_arrays(arrays, schema=self.writer.schema))
+
+    def close(self):
+        self.writer.close()
+
+class SummaryWriter(object):
+    """Per-category distributions without storing any pair: running count, sum, min and max,
+    and a fixed-bin histogram per distance column over its range (values outside it fall in
+    the edge bins), from which quantiles are interpolated. Writes the statistics to output
+    and the histograms to <output>.hist.tsv."""
+    QUANTILES = [0.025, 0.25, 0.5, 0.75, 0.975]
+
+    def __init__(self, output, samples, columns, ranges, bins=1000):
+        self.output, self.columns, self.ranges, self.bins = output, columns, ranges, bins
+        shape = (len(columns), len(CATEGORIES))
+        self.count, self.sum = np.zeros(shape, dtype=np.int64), np.zeros(shape)
+        self.min, self.max = np.full(shape, np.inf), np.full(shape, -np.inf)
+        self.hist = np.zeros(shape + (bins, ), dtype=np.int64)
+
+    def write(self, i, j, category, values):
+        for k, column in enumerate(self.columns):
+            lo, hi = self.ranges[column]
+            v = np.asarray(values[column], dtype=np.float64)
+            known = ~np.isnan(v)
+            v, cat = v[known], category[known]
+            self.count[k] += np.bincount(cat, minlength=len(CATEGORIES))
+            self.sum[k] += np.bincount(cat, weights=v, minlength=len(CATEGORIES))
+            np.minimum.at(self.min[k], cat, v)
+            np.maximum.at(self.max[k], cat, v)
+            b = np.clip(((v - lo) / (hi - lo) * self.bins).astype(np.int64), 0, self.bins - 1)
+            self.hist[k] += np.bincount(cat.astype(np.int64) * self.bins + b, minlength=len(CATEGORIES) * self.bins).reshape(len(CATEGORIES), self.bins)
+
+    def quantiles(self, k, c):
+        lo, hi = self.ranges[self.columns[k]]
+        cum = np.cumsum(self.hist[k, c])
+        edges = np.linspace(lo, hi, self.bins + 1)
+        result = []
+        for q in self.QUANTILES:
+            target = q * cum[-1]
+            b = min(int(np.searchsorted(cum, target)), self.bins - 1)
+            before = cum[b - 1] if b > 0 else 0
+            frac = (target - before) / max(cum[b] - before, 1)
+            # interpolate inside the bin, within the observed range
+            result.append(min(max(edges[b] + frac * (edges[b + 1] - edges[b]), self.min[k, c]), self.max[k, c]))
+        return result
+
+    def close(self):
+        rows, hist_rows = [], []
+        for k, column in enumerate(self.columns):
+            lo, hi = self.ranges[column]
+            edges = np.linspace(lo, hi, self.bins + 1)
+            for c, category in enumerate(CATEGORIES):
+                if self.count[k, c] == 0:
+                    continue
+                rows.append([category, column, self.count[k, c], self.sum[k, c] / self.count[k, c],
+                             self.min[k, c], self.max[k, c]] + self.quantiles(k, c))
+                for b in np.flatnonzero(self.hist[k, c]).tolist():
+                    hist_rows.append([category, column, edges[b], edges[b + 1], self.hist[k, c, b]])
+        pd.DataFrame(rows, columns=['category', 'metric', 'pairs', 'mean', 'min', 'max', '2.5%', '25%', 'median', '75%', '97.5%']
+                     ).to_csv(self.output, sep='\t', index=False)
+        pd.DataFrame(hist_rows, columns=['category', 'metric', 'bin_start', 'bin_end', 'pairs']
+                     ).to_csv(f'{self.output}.hist.tsv', sep='\t', index=False)
 
 @click.command()
 @click.option('-p', '--profile', required=True, help='Microbiome profile file path')
 @click.option('-m', '--metadata', required=True, help='Sample metadata file path')
 @click.option('-o', '--output', default='distances.tsv', help='Output file path')
-def main(profile, metadata, output):
-    """Calculate pairwise Bray-Curtis distances with sample categorization"""
+@click.option('--block-size', default=512, type=int, help='Samples per block of the distance computation')
+@click.option('--dtype', type=click.Choice(['float64', 'float32']), default='float64',
+              help='Storage precision of the abundance matrix (distances are accumulated in float64)')
+@click.option('--profile-cache', envvar='FMT_PROFILE_CACHE', default=None,
+              help='Directory for the memory-mapped cache of parsed profiles')
+@click.option('--sparse', 'layout', type=click.Choice(['auto', 'sparse', 'dense']), default='auto',
+              help='Keep the profile as a sparse matrix: always, never, or when the density of its first rows is below --density-cutoff')
+@click.option('--density-cutoff', default=0.1, type=float,
+              help='Fraction of non-zero abundances (of the first 20000 rows) below which --sparse auto uses the sparse path')
+@click.option('--format', 'output_format', type=click.Choice(['tsv', 'npy', 'parquet', 'summary']), default='tsv',
+              help='tsv rows, condensed .npy vectors, Parquet, or per-category summaries and histograms only')
+@click.option('--bins', default=1000, type=int, help='Histogram bins of --format summary')
+@click.option('--metrics', default='braycurtis',
+              help=f'Comma-separated distances computed in the same pass: {", ".join(METRICS)}')
+@click.option('--pseudocount', default=None, type=float,
+              help='Pseudocount of the Aitchison CLR (default: half the smallest non-zero abundance)')
+@click.option('--threads', default=1, type=int, help='Threads computing distance tiles')
+def main(profile, metadata, output, block_size, dtype, profile_cache, layout, density_cutoff, output_format, bins, metrics, pseudocount, threads):
+    """Calculate pairwise Bray-Curtis (and other beta-diversity) distances with sample categorization"""
+    metrics = [m.strip().lower() for m in metrics.split(',') if m.strip()]
+    unknown = [m for m in metrics if m not in METRICS]
+    if unknown or not metrics:
+        raise click.BadParameter(f'unknown metric(s) {", ".join(unknown)}; choose from {", ".join(METRICS)}', param_hint='--metrics')
     # Load data
-    profile_df = parse_profile(profile)
-    meta_df = pd.read_csv(metadata, sep='\t')
-    
-    # Set index for metadata
-    meta_df = meta_df.set_index('ID')
+    abundances, sample_ids, species = load_profile(profile, dtype, profile_cache, layout, density_cutoff)
+    meta = load_metadata(metadata)
     
-    # Filter to samples present in both files
-    common_samples = list(set(profile_df.index) & set(meta_df.index))
-    profile_df = profile_df.loc[common_samples]
-    meta_df = meta_df.loc[common_samples]
-    meta_df = meta_df[~meta_df.index.duplicated(keep='first')]
+    # Filter to samples present in both files, keeping the profile order
+    meta_rows = meta.rows(sample_ids)
+    rows = np.flatnonzero(meta_rows >= 0)
+    # a cached profile stays memory-mapped unless some samples have to be dropped
+    X = abundances if len(rows) == len(sample_ids) else abundances[rows]
+    codes = encode_metadata(meta, meta_rows[rows])
+    samples = np.asarray(sample_ids, dtype=object)[rows]
+    del abundances
     
-    # Calculate Bray-Curtis distances
-    results = []
-    sample_pairs = list(combinations(profile_df.index, 2))
-    
-    for (s1, s2) in sample_pairs:
-        dist = braycurtis(profile_df.loc[s1], profile_df.loc[s2])
-        category = categorize_pair(meta_df.loc[s1], meta_df.loc[s2])
-        results.append({
-            'Sample1': s1,
-            'Sample2': s2,
-            'BrayCurtis': dist,
-            'Category': category
-        })
-    
-    # Create and save results
-    result_df = pd.DataFrame(results)
-    result_df.to_csv(output, sep='\t', index=False)
-    print(f"Saved {len(result_df)} pairwise distances to {output}")
+    if sp.issparse(X):
+        print(f"Using the sparse path ({X.nnz / max(X.shape[0] * X.shape[1], 1):.3f} of abundances non-zero)")
+    kernels = metric_kernels(X, metrics, block_size, pseudocount)
+    columns = [METRICS[m] for m in metrics]
+    if output_format == 'summary':
+        writer = SummaryWriter(output, samples, columns, {METRICS[m]: bounds for m, (rows, bounds) in kernels.items()}, bins)
+    else:
+        writer = {'tsv': TsvWriter, 'npy': NpyWriter, 'parquet': ParquetWriter}[output_format](output, samples, columns)
+
+    # Calculate all distances block by block, categorizing each block once for every metric
+    n_pairs = 0
+    try:
+        for i, j, dists in distance_blocks(X, metrics, block_size, threads, kernels=kernels):
+            writer.write(i, j, categorize_pairs(codes, i, j), {METRICS[m]: d for m, d in dists.items()})
+            n_pairs += len(i)
+    finally:
+        writer.close()
+    if output_format == 'summary':
+        print(f"Summarized {n_pairs} pairwise distances in {output}")
+    else:
+        print(f"Saved {n_pairs} pairwise distances to {output}")
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -1,6 +1,9 @@
-import ete3, json
+import json
+import numpy as np
+from nwk_tree import load_tree
 import sys
 import click
+from tree_pool import tree_pool
 
 def is_reference_genome(name):
     """Check if the leaf name is a reference genome (GCF_ followed by digits)"""
@@ -10,11 +13,72 @@ def is_reference_genome(name):
     return False
 
 
+def reference_sets(tree):
+    """Name -> node index (the shallowest node of that name, as a level-order search finds it)
+    and the sorted preorder indices of the reference leaves (no '|' in the name)"""
+    parent = tree.parent.tolist()
+    depth = [0] * len(parent)
+    for n in range(1, len(parent)):
+        depth[n] = depth[parent[n]] + 1
+    index = {}
+    names = tree.names.tolist()
+    for n in sorted(range(len(names)), key=lambda n: (depth[n], n)):
+        index.setdefault(names[n], n)
+    leaves = tree.leaves()
+    refs = leaves[np.char.find(tree.names[leaves], '|') < 0]
+    return index, refs
+
+
+# Per-worker state, filled once by init_worker
+_tree_cache = None
+
+def init_worker(tree_cache):
+    global _tree_cache
+    _tree_cache = tree_cache
+
+
+def process_tree(task):
+    """Resolve every input row of one tree; returns [(row number, output line)] and messages"""
+    tree_path, rows = task
+    try:
+        tree = load_tree(tree_path, _tree_cache)
+    except Exception as e:
+        return [(k, f"{tree_path}\t{node_name}\tNA\tNA\n") for k, sig, node_name, rates in rows], \
+               [f"Error loading tree {tree_path}: {str(e)}"] * len(rows)
+
+    index, refs = reference_sets(tree)
+    names = tree.names
+    lines, messages = [], []
+    for k, sig, node_name, rates in rows:
+        if node_name not in index:
+            messages.append(f"Node {node_name} not found in {tree_path}")
+            lines.append((k, f"{tree_path}\t{node_name}\tNA\tNA\n"))
+            continue
+        node = index[node_name]
+
+        # The subtree of a node is a contiguous preorder range, so its reference leaves
+        # are a slice of the sorted reference indices and the outgroup is the rest
+        lo, hi = np.searchsorted(refs, [node, node + tree.size[node]])
+        in_ref = names[refs[lo:hi]].tolist()
+        out_ref = names[np.concatenate([refs[:lo], refs[hi:]])].tolist()
+
+        if rates[0][1]/(rates[0][0] + rates[0][1]) < rates[1][1]/(rates[1][0] + rates[1][1]):
+            lines.append((k, f'{tree_path}\t{sig}\t{node_name}\t|\t{",".join(in_ref)}\t|\t{",".join(out_ref)}\n'))
+        else :
+            lines.append((k, f'{tree_path}\t{sig}\t{node_name}\t|\t{",".join(out_ref)}\t|\t{",".join(in_ref)}\n'))
+    return lines, messages
+
+
 @click.command()
 @click.argument('input_file', type=click.Path(exists=True))
 @click.argument('output_file', type=click.Path())
-def main(input_file, output_file):
-    with open(input_file, 'r') as fin, open(output_file, 'w') as fout:
+@click.option('--workers', default=8, type=int, help='Number of parallel workers, each handling whole trees')
+@click.option('--tree-cache', envvar='FMT_TREE_CACHE', default=None, help='Directory for the binary cache of parsed trees')
+def main(input_file, output_file, workers, tree_cache):
+    # Group the input rows by tree so that every tree is loaded once
+    groups = {}
+    n_rows = 0
+    with open(input_file, 'r') as fin:
         for line in fin:
             parts = line.strip().split('\t')
             if not parts or len(parts) < 5:
@@ -24,36 +88,19 @@ def main(input_file, output_file):
             sig = parts[1]
             rates = json.loads(parts[5])
             node_name = parts[4]
-            
-            try:
-                # Load tree with flexible format detection
-                tree = ete3.Tree(tree_path, format=1)
-            except Exception as e:
-                print(f"Error loading tree {tree_path}: {str(e)}", file=sys.stderr)
-                fout.write(f"{tree_path}\t{node_name}\tNA\tNA\n")
-                continue
-                
-            # Find the target node
-            node = None
-            for n in tree.traverse():
-                if n.name == node_name:
-                    node = n
-                    break
-            
-            if node is None:
-                print(f"Node {node_name} not found in {tree_path}", file=sys.stderr)
-                fout.write(f"{tree_path}\t{node_name}\tNA\tNA\n")
-                continue
-            
-            ingroup = node.get_leaf_names()
-            in_ref = [g for g in ingroup if g.find('|') < 0]
-            outgroup = set(tree.get_leaf_names()) - set(ingroup)
-            out_ref = [g for g in outgroup if g.find('|') < 0]
-            
-            if rates[0][1]/(rates[0][0] + rates[0][1]) < rates[1][1]/(rates[1][0] + rates[1][1]):
-                fout.write(f'{tree_path}\t{sig}\t{node_name}\t|\t{",".join(in_ref)}\t|\t{",".join(out_ref)}\n')
-            else :
-                fout.write(f'{tree_path}\t{sig}\t{node_name}\t|\t{",".join(out_ref)}\t|\t{",".join(in_ref)}\n')
+            groups.setdefault(tree_path, []).append((n_rows, sig, node_name, rates))
+            n_rows += 1
+
+    # Write the rows back in input order
+    out_lines = [None] * n_rows
+    with tree_pool(workers if len(groups) > 1 else 1, init_worker, (tree_cache,)) as imap:
+        for lines, messages in imap(process_tree, groups.items()):
+            for msg in messages:
+                print(msg, file=sys.stderr)
+            for k, out in lines:
+                out_lines[k] = out
+    with open(output_file, 'w') as fout:
+        fout.writelines(out_lines)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,79 +1,83 @@
 import pandas as pd
+import numpy as np
 import json
 import click
 
+# Genotype codes of the feature table; -1 (missing) is written as '-'
+HEALTHY, DISEASE, MISSING = 0, 1, -1
+LABELS = np.array(['H', 'D', '-'])
+
+def genotype_calls(significant):
+    """All (species, sample, genotype code) assignments of the significant rows, in input order,
+    so that a later row of the same species overrides an earlier one"""
+    # Determine genotype based on disease association: [[in_H, in_D], [out_H, out_D]]
+    counts = np.array([json.loads(c) for c in significant['disease_counts']], dtype=np.float64).reshape(-1, 2, 2)
+    totals = counts.sum(2)
+    p = np.divide(counts[:, :, 1], totals, out=np.zeros_like(totals), where=totals > 0)
+    geno_in = np.where(p[:, 0] > p[:, 1], DISEASE, HEALTHY)
+
+    species, samples, genotypes = [], [], []
+    for sp, ingroup, outgroup, g_in in zip(significant['species'], significant['ingroup'], significant['outgroup'], geno_in.tolist()):
+        in_samples, out_samples = json.loads(ingroup), json.loads(outgroup)
+        # Remove any sample present in both groups
+        common = set(in_samples) & set(out_samples)
+        if common:
+            in_samples = [s for s in in_samples if s not in common]
+            out_samples = [s for s in out_samples if s not in common]
+        species.extend([sp] * (len(in_samples) + len(out_samples)))
+        samples.extend(in_samples + out_samples)
+        genotypes.extend([g_in] * len(in_samples) + [1 - g_in] * len(out_samples))
+    return pd.DataFrame({'species': species, 'sample': samples, 'genotype': np.array(genotypes, dtype=np.int8)})
+
+def feature_table(calls, species=None):
+    """Pivot the calls into an int8 (species x samples) matrix in one step, species and samples
+    sorted; returns (matrix, species, samples) with MISSING where a sample has no call.
+    species lists every species of the table, so that those without any call left get a
+    row of MISSING; by default only the species of the calls are kept."""
+    calls = calls.drop_duplicates(['species', 'sample'], keep='last')
+    if species is None:
+        sp_codes, species = pd.factorize(calls['species'], sort=True)
+    else:
+        species = pd.Index(sorted(set(species) | set(calls['species'])))
+        sp_codes = species.get_indexer(calls['species'])
+    sa_codes, samples = pd.factorize(calls['sample'], sort=True)
+    matrix = np.full((len(species), len(samples)), MISSING, dtype=np.int8)
+    matrix[sp_codes, sa_codes] = calls['genotype'].to_numpy()
+    return matrix, list(species), list(samples)
+
 @click.command()
 @click.option('--input', '-i', required=True, help="Input TSV file from the tree analysis")
 @click.option('--output', '-o', required=True, help="Output feature table TSV file")
-def main(input, output):
+@click.option('--format', 'output_format', type=click.Choice(['wide', 'long']), default='wide',
+              help="wide: species x samples table of H/D/-; long: one species, sample, genotype row per call")
+def main(input, output, output_format):
     # Read the input TSV
     df = pd.read_csv(input, sep='\t', header=None, names=[
-        'tree_path', 'cmh_pvalue', 'health_fisher', 'cohort_fisher', 
-        'node', 'disease_counts', 'cohort_counts', 'ingroup', 'outgroup'
+        'tree_path', 'cmh_pvalue', 'health_fisher', 'cohort_fisher',
+        'node', 'disease_counts', 'cohort_counts', 'ingroup', 'outgroup',
+        'permutation_pvalue'  # only written with --permutations
     ])
 
     # Filter significant rows (CMH p-value < 0.05)
     significant = df[df['cmh_pvalue'] < 0.05].copy()
-    
+
     # Extract species name from tree_path (e.g., 'all_cohorts/Alistipes_senegalensis/uscg.nwk')
-    significant['species'] = significant['tree_path'].apply(lambda x: x.split('/')[1])
-    
-    # Initialize a dictionary to collect sample assignments and a set for all samples
-    species_genotypes = {}
-    all_samples = set()
+    significant['species'] = significant['tree_path'].str.split('/').str[1]
+
+    calls = genotype_calls(significant)
+    if output_format == 'long':
+        # Only the calls, which stays small however wide the table would be
+        calls = calls.drop_duplicates(['species', 'sample'], keep='last').sort_values(['species', 'sample'])
+        calls['genotype'] = LABELS[calls['genotype'].to_numpy()]
+        calls.to_csv(output, sep='\t', index=False)
+        return
+
+    # Create feature table (species x samples), '-' for missing data
+    matrix, species, samples = feature_table(calls, significant['species'])
+    feature_df = pd.DataFrame(LABELS[matrix], index=species, columns=samples)
 
-    # Process each significant species
-    for _, row in significant.iterrows():
-        species = row['species']
-        d_counts = json.loads(row['disease_counts'])  # [[in_H, in_D], [out_H, out_D]]
-        in_samples = json.loads(row['ingroup'])
-        out_samples = json.loads(row['outgroup'])
-        
-        # Remove any sample present in both groups
-        common = set(in_samples) & set(out_samples)
-        if common:
-            in_samples = [s for s in in_samples if s not in common]
-            out_samples = [s for s in out_samples if s not in common]
-        
-        # Determine genotype based on disease association
-        in_H, in_D = d_counts[0]
-        out_H, out_D = d_counts[1]
-        p_in = in_D / (in_H + in_D) if (in_H + in_D) > 0 else 0
-        p_out = out_D / (out_H + out_D) if (out_H + out_D) > 0 else 0
-        
-        if p_in > p_out:
-            geno_in = "D"
-            geno_out = "H"
-        else:
-            geno_in = "H"
-            geno_out = "D"
-        
-        # Store assignments for this species
-        if species not in species_genotypes:
-            species_genotypes[species] = {}
-        for s in in_samples:
-            species_genotypes[species][s] = geno_in
-        for s in out_samples:
-            species_genotypes[species][s] = geno_out
-        
-        # Track all unique samples
-        all_samples.update(in_samples + out_samples)
-    
-    # Create feature table (species x samples)
-    samples_sorted = sorted(all_samples)
-    species_sorted = sorted(species_genotypes.keys())
-    
-    # Initialize DataFrame with '-' for missing data
-    feature_df = pd.DataFrame('-', index=species_sorted, columns=samples_sorted, dtype=str)
-    
-    # Fill in genotypes
-    for species in species_sorted:
-        for sample, geno in species_genotypes[species].items():
-            if sample in feature_df.columns:
-                feature_df.at[species, sample] = geno
-    
     # Save to TSV
     feature_df.to_csv(output, sep='\t')
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -1,6 +1,8 @@
-import click, ete3, pandas as pd, numpy as np, collections, json, sys
-from scipy.stats import fisher_exact
-from statsmodels.stats.contingency_tables import StratifiedTable  # Added for CMH test
+import click, numpy as np, json, sys, time
+from nwk_tree import load_tree
+from sample_metadata import load_metadata
+from tree_pool import tree_pool
+import batch_stats
 
 #before_FMT & non-responder are counted as disease
 #healthy & responder are counted as healthy
@@ -11,116 +13,210 @@ h_codes = {'H': 0, 'D': 1}
 c_codes = {'rCDI':0, 'IBS':1, 'LUAD':2, 'MEL': 3}
 cohort_names = {v: k for k, v in c_codes.items()}  # Reverse mapping for cohorts
 
-def get_optimal_cut(tre, samples) :
-    tips = {}
-    for tip in tre.get_leaves() :
-        info = tip.name.split('|')
-        if info[0] in samples :
-            tips[tip.name] = samples[info[0]]
-    
-    branches = []
-    for n in tre.traverse('postorder') :
-        if n.is_leaf() :
-            if n.name in tips :
-                n.d = set([n.name])
-            else :
-                n.d = set([])
+def lca(parent, size, a, b) :
+    """Lowest common ancestor of preorder nodes a <= b"""
+    while not a <= b < a + size[a] :
+        a = parent[a]
+    return a
+
+def subtree_sums(delta, size) :
+    """Sum of the per-node rows of delta over every subtree, using the preorder ranges"""
+    cs = np.zeros((len(delta) + 1, ) + delta.shape[1:], dtype=delta.dtype)
+    np.cumsum(delta, axis=0, out=cs[1:])
+    idx = np.arange(len(delta))
+    return cs[idx + size] - cs[idx]
+
+def sample_keys(meta, names) :
+    """Integer (individual, cohort, health) key of each sample name, with the cohort and
+    health codes recoverable as key // len(h_codes) % len(c_codes) and key % len(h_codes);
+    -1 for samples not in meta, without an individual, or whose cohort or disease type is
+    not in c_codes / conv"""
+    cohort = meta.lookup('Cohort', c_codes)
+    health = meta.lookup('Disease type', {k: h_codes[v] for k, v in conv.items()})
+    individual = meta.codes['individual'].astype(np.int64)
+    key = np.where((cohort >= 0) & (health >= 0) & (individual >= 0),
+                   (individual * len(c_codes) + cohort) * len(h_codes) + health, -1)
+    # row -1 (not in meta) picks the trailing -1
+    return np.append(key, -1)[meta.rows(names)]
+
+def count_tables(tre, meta) :
+    """Postorder count engine for get_optimal_cut.
+    A key is a distinct (cohort, individual, health), see sample_keys. For every node it returns the
+    number of tips and the (cohort x health) counts of keys inside (at least one tip in the
+    subtree) and outside (at least one tip elsewhere). Distinct keys are counted by adding
+    +1 at each tip and -1 at the LCA of consecutive tips of a key (in preorder), and a key is
+    entirely inside a subtree iff the LCA of all its tips is, so outside = total - entirely
+    inside. All counts are then subtree sums, i.e. differences of preorder prefix sums."""
+    n = len(tre)
+    parent, size = tre.parent.tolist(), tre.size.tolist()
+    tip_keys = sample_keys(meta, tre.samples).tolist()
+    tips = [t for t in tre.leaves().tolist() if tip_keys[t] >= 0]
+    keys, first, last = {}, {}, {}
+    tip_delta = np.zeros(n, dtype=np.int64)
+    in_delta = np.zeros((n, len(c_codes), len(h_codes)), dtype=np.int64)
+    full_delta = np.zeros((n, len(c_codes), len(h_codes)), dtype=np.int64)
+    for t in tips :
+        info = tip_keys[t]
+        k = keys.setdefault(info, (info // len(h_codes) % len(c_codes), info % len(h_codes)))
+        tip_delta[t] += 1
+        in_delta[(t, ) + k] += 1
+        if info in last :
+            in_delta[(lca(parent, size, last[info], t), ) + k] -= 1
         else :
-            n.d = set([d for c in n.children for d in c.d])
-            if len(n.d) > 1 :
-                ingroup = collections.defaultdict(list)
-                outgroup = collections.defaultdict(list)
-                for t, info in tips.items() :
-                    if t in n.d :
-                        ingroup[info].append(t.split('|')[0])
-                    else :
-                        outgroup[info].append(t.split('|')[0])
-                if len(ingroup) > 1 and len(outgroup) > 1 :
-                    # Disease counts (for output only)
-                    d_h = [
-                        np.bincount([h_codes[x[2]] for x in ingroup.keys()], minlength=len(h_codes)),
-                        np.bincount([h_codes[x[2]] for x in outgroup.keys()], minlength=len(h_codes))
-                    ]
-                    if np.sum(d_h[0]) < 0.1*np.sum(d_h) or np.sum(d_h[0]) > 0.9*np.sum(d_h):
-                        continue
-                    # Cohort counts
-                    d_c = [
-                        np.bincount([c_codes[x[0]] for x in ingroup.keys()], minlength=len(c_codes)),
-                        np.bincount([c_codes[x[0]] for x in outgroup.keys()], minlength=len(c_codes))
-                    ]
-                    if np.sum(np.min(d_c, 0) >= 0.1*np.sum(d_c, 0)) < 0.5*len(d_c[0]):
-                        continue
-
-                    # Handle cohort test (original Fisher's exact for cohort distribution)
-                    res_h = fisher_exact(d_h)
-                    health_fisher = res_h[1] if isinstance(res_h, tuple) else res_h
-                    res_c = fisher_exact(d_c)
-                    cohort_fisher = res_c[1] if isinstance(res_c, tuple) else res_c
-                    
-                    # ===== NEW: CMH TEST FOR DISEASE (ADJUSTED FOR COHORT) =====
-                    # Build stratified tables by cohort
-                    cmh_tables = []
-                    for cohort_idx in range(len(c_codes)):
-                        cohort_name = cohort_names[cohort_idx]
-                        in_H = 0
-                        in_D = 0
-                        out_H = 0
-                        out_D = 0
-                        
-                        # Count disease status in ingroup for this cohort
-                        for info in ingroup.keys():
-                            if info[0] == cohort_name:
-                                if info[2] == 'H': in_H += 1
-                                else: in_D += 1
-                                
-                        # Count disease status in outgroup for this cohort
-                        for info in outgroup.keys():
-                            if info[0] == cohort_name:
-                                if info[2] == 'H': out_H += 1
-                                else: out_D += 1
-                        
-                        # Only include cohorts with data
-                        if in_H + in_D + out_H + out_D > 0:
-                            cmh_tables.append([[in_H, in_D], [out_H, out_D]])
-                    
-                    # Run CMH test if valid tables exist
-                    cmh_pvalue = 1.0  # Default if test fails
-                    if len(cmh_tables) > 0:
-                        try:
-                            st = StratifiedTable(cmh_tables, shift_zeros=True)
-                            cmh_result = st.test_null_odds()
-                            cmh_pvalue = cmh_result.pvalue
-                        except Exception as e:
-                            print(f"CMH error: {e}", file=sys.stderr)
-                    # ===== END CMH TEST =====
-                    
-                    
-                    branches.append([
-                        cmh_pvalue,            # Disease p-value (CMH-adjusted)
-                        health_fisher,
-                        cohort_fisher,         # Cohort p-value (Fisher's)
-                        n.name, 
-                        np.array(d_h).tolist(),
-                        np.array(d_c).tolist(), 
-                        list(set([ss for s in ingroup.values() for ss in s])), 
-                        list(set([ss for s in outgroup.values() for ss in s]))
-                    ])
-
-    return min(branches) if branches else None
+            first[info] = t
+        last[info] = t
+    total = np.zeros((len(c_codes), len(h_codes)), dtype=np.int64)
+    for info, k in keys.items() :
+        full_delta[(lca(parent, size, first[info], last[info]), ) + k] += 1
+        total[k] += 1
+    size = np.asarray(tre.size, dtype=np.int64)
+    return tips, subtree_sums(tip_delta, size), subtree_sums(in_delta, size), total - subtree_sums(full_delta, size)
+
+def permutation_pvalue(tre, tips, meta, nodes, observed, permutations, rng, block=64) :
+    """Family-wise p-value of the best CMH p-value over the candidate nodes: health labels are
+    shuffled among the keys of each cohort, and the best p-value of every permutation is
+    compared with the observed one. The candidate filters only use counts summed over health,
+    so the candidates do not change; the counts of a block of permutations are products of
+    node x key membership matrices (keys with a tip inside / outside) and key x permutation
+    label matrices, one per cohort."""
+    key_index = {}
+    tip_key = np.array([key_index.setdefault(k, len(key_index)) for k in sample_keys(meta, tre.samples[np.asarray(tips, dtype=np.int64)]).tolist()], dtype=np.int64)
+    key_values = np.fromiter(key_index, dtype=np.int64, count=len(key_index))
+    key_cohort, key_health = key_values // len(h_codes) % len(c_codes), key_values % len(h_codes)
+
+    # number of tips of every key inside every candidate node, from its sorted tip positions
+    tips = np.asarray(tips, dtype=np.int64)
+    order = np.lexsort((tips, tip_key))
+    bounds = np.searchsorted(tip_key[order], np.arange(len(key_index) + 1))
+    starts, ends = nodes.astype(np.int64), nodes.astype(np.int64) + tre.size[nodes]
+    inside = np.empty((len(nodes), len(key_index)), dtype=np.int64)
+    for k in range(len(key_index)) :
+        pos = tips[order[bounds[k]:bounds[k+1]]]
+        inside[:, k] = np.searchsorted(pos, ends) - np.searchsorted(pos, starts)
+    member_in = (inside > 0).astype(np.float64)
+    member_out = (inside < np.diff(bounds)).astype(np.float64)
+
+    cohort_keys = [np.flatnonzero(key_cohort == c) for c in range(len(c_codes))]
+    n_in = np.stack([member_in[:, keys].sum(1) for keys in cohort_keys], 1)
+    n_out = np.stack([member_out[:, keys].sum(1) for keys in cohort_keys], 1)
+    exceed = 0
+    for start in range(0, permutations, block) :
+        labels = np.tile(key_health, (min(block, permutations - start), 1))
+        for keys in cohort_keys :
+            labels[:, keys] = rng.permuted(labels[:, keys], axis=1)
+        # (permutation x node x cohort x in/out x health) tables, laid out as in get_optimal_cut
+        tables = np.empty((len(labels), len(nodes), len(c_codes), 2, 2))
+        for c, keys in enumerate(cohort_keys) :
+            d_in = (member_in[:, keys] @ labels[:, keys].T).T
+            d_out = (member_out[:, keys] @ labels[:, keys].T).T
+            tables[:, :, c, 0, h_codes['D']], tables[:, :, c, 0, h_codes['H']] = d_in, n_in[:, c] - d_in
+            tables[:, :, c, 1, h_codes['D']], tables[:, :, c, 1, h_codes['H']] = d_out, n_out[:, c] - d_out
+        _, pvalues = batch_stats.cmh_pvalues(tables)
+        exceed += int((pvalues.min(1) <= observed).sum())
+    return (exceed + 1.) / (permutations + 1.)
+
+def get_optimal_cut(tre, meta, permutations=0, rng=None) :
+    tips, n_tips, in_cnt, out_cnt = count_tables(tre, meta)
+
+    # Disease counts (for output only) and cohort counts of every node
+    d_h = np.stack([in_cnt.sum(1), out_cnt.sum(1)], 1)
+    d_c = np.stack([in_cnt.sum(2), out_cnt.sum(2)], 1)
+    in_total, all_total = d_h[:, 0].sum(1), d_h.sum((1, 2))
+    candidates = (tre.size > 1) & (n_tips > 1) & (in_cnt.sum((1, 2)) > 1) & (out_cnt.sum((1, 2)) > 1)
+    candidates &= (in_total >= 0.1*all_total) & (in_total <= 0.9*all_total)
+    candidates &= np.sum(d_c.min(1) >= 0.1*d_c.sum(1), 1) >= 0.5*len(c_codes)
+
+    # Statistics for all candidate nodes at once; CMH on (node x cohort x 2 x 2) tables
+    # of disease counts. Only min() of the branch tuples is reported, so the Fisher p-values,
+    # memoized on the count tables, are only computed for nodes still tied on the earlier fields
+    nodes = tre.postorder[candidates[tre.postorder]]
+    if len(nodes) == 0 :
+        return None
+    _, cmh_pvalues = batch_stats.cmh_pvalues(np.stack([in_cnt[nodes], out_cnt[nodes]], 2))
+    names = tre.names.tolist()
+    best_p = min(cmh_pvalues.tolist())
+    branches = [(best_p, batch_stats.fisher_pvalue(d_h[n]), n) for n in nodes[cmh_pvalues == best_p].tolist()]
+    best_h = min(b[1] for b in branches)
+    branches = [(
+
+        p,                                   # Disease p-value (CMH-adjusted)
+        health_fisher,
+        batch_stats.fisher_pvalue(d_c[n]),   # Cohort p-value (Fisher's)
+        names[n], 
+        d_h[n].tolist(),
+        d_c[n].tolist(),
+        n
+    ) for p, health_fisher, n in branches if health_fisher == best_h]
+
+    best = min(branches)
+    # Member sample lists are only needed for the winning branch
+    n = best[-1]
+    tip_idx = np.array(tips, dtype=np.int64)
+    inside = (tip_idx >= n) & (tip_idx < n + tre.size[n])
+    tip_samples = tre.samples[tip_idx]
+    data = list(best[:-1]) + [sorted(set(tip_samples[inside].tolist())), sorted(set(tip_samples[~inside].tolist()))]
+    if permutations > 0 :
+        data.append(permutation_pvalue(tre, tips, meta, nodes, best_p, permutations, rng or np.random.default_rng()))
+    return data
+
+def format_row(nwk, data) :
+    row = f'{nwk}\t{data[0]}\t{data[1]}\t{data[2]}\t{data[3]}\t{json.dumps(data[4]).replace(" ", "")}\t{json.dumps(data[5]).replace(" ", "")}\t{json.dumps(data[6]).replace(" ", "")}\t{json.dumps(data[7]).replace(" ", "")}'
+    # permutation p-value, only with --permutations
+    return row + f'\t{data[8]}' if len(data) > 8 else row
+
+# Per-worker state of the --tree-list mode, filled once by init_worker
+_meta = None
+_tree_cache = None
+_permutations, _seed = 0, None
+
+def init_worker(meta, tree_cache, permutations=0, seed=None) :
+    global _meta, _tree_cache, _permutations, _seed
+    _meta, _tree_cache = meta, tree_cache
+    _permutations, _seed = permutations, seed
+
+def process_tree(nwk) :
+    """Run get_optimal_cut on one tree; returns (nwk, output row or None, seconds, error)"""
+    start = time.time()
+    try :
+        # every tree gets its own generator from the seed, whatever worker runs it
+        data = get_optimal_cut(load_tree(nwk, _tree_cache), _meta, _permutations, np.random.default_rng(_seed))
+    except Exception as e :
+        return nwk, None, time.time() - start, f'{type(e).__name__}: {e}'
+    return nwk, format_row(nwk, data) if data else None, time.time() - start, None
 
 @click.command()
 @click.option('-m', '--metadata')
 @click.option('-n', '--nwk')
-def main(metadata, nwk) :
-    meta = pd.read_csv(metadata, sep='\t', header=0)
-    samples = {}
-    for id, cohort, individual, day, dtype in meta[['ID', 'Cohort', 'individual', 'Day', 'Disease type']].values :
-        samples[id] = (cohort, individual, conv[dtype])
-
-    tre = ete3.Tree(nwk, format=1)
-    data = get_optimal_cut(tre, samples)
-    if data:
-        print(f'{nwk}\t{data[0]}\t{data[1]}\t{data[2]}\t{data[3]}\t{json.dumps(data[4]).replace(" ", "")}\t{json.dumps(data[5]).replace(" ", "")}\t{json.dumps(data[6]).replace(" ", "")}\t{json.dumps(data[7]).replace(" ", "")}')
+@click.option('-t', '--tree-list', help='File listing one tree per line; processed in a pool, rows kept in list order')
+@click.option('--workers', default=8, type=int, help='Number of parallel workers for --tree-list')
+@click.option('--tree-cache', envvar='FMT_TREE_CACHE', default=None, help='Directory for the binary cache of parsed trees')
+@click.option('-p', '--permutations', default=0, type=int, help='Health label permutations within cohorts for a family-wise p-value of the best branch (adds a column)')
+@click.option('-s', '--seed', default=None, type=int, help='Random seed of the permutations')
+def main(metadata, nwk, tree_list, workers, tree_cache, permutations, seed) :
+    meta = load_metadata(metadata)
+
+    if not tree_list :
+        tre = load_tree(nwk, tree_cache)
+        data = get_optimal_cut(tre, meta, permutations, np.random.default_rng(seed))
+        if data:
+            print(format_row(nwk, data))
+        return
+
+    with open(tree_list) as fin :
+        nwk_files = [line.strip() for line in fin if line.strip()]
+    start, n_skipped = time.time(), 0
+    with tree_pool(workers, init_worker, (meta, tree_cache, permutations, seed)) as imap :
+        # ordered, so each row is written as soon as it and all earlier trees are done
+        results = imap(process_tree, nwk_files, ordered=True, chunksize=max(1, min(8, len(nwk_files) // (max(workers, 1) * 4))))
+        for k, (nwk, row, seconds, error) in enumerate(results) :
+            if error :
+                n_skipped += 1
+                print(f'[{k+1}/{len(nwk_files)}] skipped {nwk}: {error}', file=sys.stderr)
+            else :
+                print(f'[{k+1}/{len(nwk_files)}] {nwk}\t{seconds:.2f}s', file=sys.stderr)
+            if row :
+                print(row, flush=True)
+    print(f'Processed {len(nwk_files)} trees in {time.time() - start:.1f}s, {n_skipped} skipped', file=sys.stderr)
 
 if __name__ == '__main__' :
     main()
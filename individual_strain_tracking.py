@@ -1,62 +1,156 @@
-import click, ete3, pandas as pd, numpy as np, collections
+import click, numpy as np, collections
+from nwk_tree import load_tree
+from strain_distance import parse_thresholds, PairDistanceStore
+from sample_metadata import load_metadata
 
 
-def get_distance(tre, samples) :
+def encode_samples(meta) :
+    """Per metadata row, an integer key of its (cohort, individual) and the code of its day
+    (codes sort like the days); rows that are left out (before_FMT, or a missing cohort,
+    individual or day) get -1"""
+    n_individuals = len(meta.values['individual'])
+    cohort, individual, day = (meta.codes[c].astype(np.int64) for c in ('Cohort', 'individual', 'Day'))
+    used = (cohort >= 0) & (individual >= 0) & (day >= 0) & (meta.lookup('Disease type', {'before_FMT': 1}, 0) == 0)
+    return np.where(used, cohort * n_individuals + individual, -1), np.where(used, day, -1)
+
+def decode_pairs(meta, pairs) :
+    """{(individual key, day code 1, day code 2): distance} as {cohort: {individual: {(day1, day2): distance}}}"""
+    n_individuals = len(meta.values['individual'])
+    cohorts, individuals = np.asarray(meta.values['Cohort']).tolist(), np.asarray(meta.values['individual']).tolist()
+    days = np.asarray(meta.values['Day']).tolist()
     individual_pairs = collections.defaultdict(lambda : collections.defaultdict(dict))
-    for n in tre.traverse('postorder') :
-        if n.is_leaf() :
-            info = n.name.split('|')
-            if info[0] in samples :
-                n.d = [[n.name, info[0], n.dist, 0.]]
+    for (idv, day1, day2), d in pairs.items() :
+        individual_pairs[cohorts[idv // n_individuals]][individuals[idv % n_individuals]][(days[day1], days[day2])] = d
+    return individual_pairs
+
+def get_distance(tre, meta) :
+    """Minimum tip-to-tip distance per (cohort, individual, day pair) in an NwkTree.
+    Each subtree only keeps the minimum adjusted depth per (individual, day), with the
+    low_qual leaf scaling applied once at the leaf, so joining two children costs
+    days x days per shared individual instead of tips x tips; individuals and days are
+    integer codes of meta until the result is decoded."""
+    pairs = {}
+    leaf_len, dist = tre.leaf_lengths().tolist(), tre.dist.tolist()
+    idv_key, day_code = encode_samples(meta)
+    rows = meta.rows(tre.samples)
+    tip_idv = np.where(rows >= 0, idv_key[rows], -1).tolist()
+    tip_day = np.where(rows >= 0, day_code[rows], -1).tolist()
+    ptr, cidx = tre.child_ptr.tolist(), tre.child_idx.tolist()
+    d = [None] * len(leaf_len)
+    for n in tre.postorder.tolist() :
+        if ptr[n] == ptr[n+1] :
+            if tip_idv[n] >= 0 :
+                d[n] = {tip_idv[n]: {tip_day[n]: leaf_len[n]}}
             else :
-                n.d = []
+                d[n] = {}
         else :
-            for i, c1 in enumerate(n.children) :
-                for j, c2 in enumerate(n.children[:i]) :
-                    if len(c1.d) and len(c2.d) :
-                        for t1 in c1.d :
-                            for t2 in c2.d :
-                                if (t1[1] != t2[1]) and (samples[t1[1]][0] == samples[t2[1]][0]) and samples[t1[1]][1] != samples[t2[1]][1] :
-                                    diff_day = tuple(sorted([samples[t1[1]][1], samples[t2[1]][1]]))
-                                    dist = t1[3] + t2[3] + (t1[2] if 'low_qual' in t1[0] else t1[2]/4) + (t2[2] if 'low_qual' in t2[0] else t2[2]/4)
-                                    if diff_day not in individual_pairs[samples[t1[1]][0][0]][samples[t1[1]][0][1]] or individual_pairs[samples[t1[1]][0][0]][samples[t1[1]][0][1]][diff_day] > dist :
-                                        individual_pairs[samples[t1[1]][0][0]][samples[t1[1]][0][1]][diff_day] = dist
-            n.d = [[d[0], d[1], d[2], d[3] + n.dist] for c in n.children for d in c.d]
-    return individual_pairs
+            children = cidx[ptr[n]:ptr[n+1]]
+            for i, c1 in enumerate(children) :
+                for c2 in children[:i] :
+                    for idv in (d[c1].keys() & d[c2].keys()) :
+                        for day1, d1 in d[c1][idv].items() :
+                            for day2, d2 in d[c2][idv].items() :
+                                if day1 != day2 :
+                                    key = (idv, day1, day2) if day1 < day2 else (idv, day2, day1)
+                                    if key not in pairs or pairs[key] > d1 + d2 :
+                                        pairs[key] = d1 + d2
+            d[n] = {}
+            for c in children :
+                for idv, days in d[c].items() :
+                    depths = d[n].setdefault(idv, {})
+                    for day, depth in days.items() :
+                        if day not in depths or depths[day] > depth + dist[n] :
+                            depths[day] = depth + dist[n]
+                d[c] = None
+    return decode_pairs(meta, pairs)
+
+def stored_distance(store, nwk, meta) :
+    """get_distance from the sample pair distances of a PairDistanceStore: the minimum of
+    a day pair is the minimum over the sample pairs of that individual and those days"""
+    pairs = {}
+    names, i, j, dists = store.query(nwk, samples=meta.index)
+    idv_key, day_code = encode_samples(meta)
+    rows = meta.rows(names)
+    idv, day = idv_key[rows], day_code[rows]
+    keep = (idv[i] == idv[j]) & (idv[i] >= 0) & (day[i] != day[j])
+    day1, day2 = np.minimum(day[i], day[j])[keep], np.maximum(day[i], day[j])[keep]
+    for key, d in zip(zip(idv[i][keep].tolist(), day1.tolist(), day2.tolist()), dists[keep].tolist()) :
+        if key not in pairs or pairs[key] > d :
+            pairs[key] = d
+    return decode_pairs(meta, pairs)
+
+def persistence_counts(individuals, thresholds=(0.001, )) :
+    """Per individual, the number of shared (dist <= threshold) and of all day pairs in each
+    power-of-two day bin; the last bin (SUM) holds whether the closest pair is shared.
+    shared has one (individuals x bins) slice per threshold, all from the same distances."""
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    bins = sorted({int(np.power(2, int(np.log2(dates[1] - dates[0])))) for idv in individuals for dates in idv})
+    col = {b: i for i, b in enumerate(bins)}
+    shared = np.zeros((len(thresholds), len(individuals), len(bins) + 1))
+    total = np.zeros((len(individuals), len(bins) + 1))
+    for k, idv in enumerate(individuals) :
+        dates = np.array(list(idv.keys()))
+        dists = np.array(list(idv.values()))
+        cols = [col[b] for b in np.power(2, np.log2(dates[:, 1] - dates[:, 0]).astype(int)).tolist()]
+        for t, threshold in enumerate(thresholds) :
+            np.add.at(shared[t, k], cols, dists <= threshold)
+        np.add.at(total[k], cols, 1)
+        shared[:, k, -1], total[k, -1] = dists.min() <= thresholds, 1
+    return bins + ['SUM'], shared, total
+
+def bootstrap(shared, total, replicates, rng, block=10000) :
+    """Persistence of each bin in bootstrap replicates of the individuals: every replicate
+    is a multinomial count vector over individuals, so its shared/total ratios are two
+    matrix products. The same replicates serve every threshold slice of shared.
+    Returns (thresholds x replicates x bins); bins absent from a replicate are NaN."""
+    n_thr, n, n_bins = shared.shape
+    flat = shared.transpose(1, 0, 2).reshape(n, n_thr * n_bins)
+    vals = np.empty((n_thr, replicates, n_bins))
+    for start in range(0, replicates, block) :
+        counts = rng.multinomial(n, np.full(n, 1./n), size=min(block, replicates - start))
+        with np.errstate(invalid='ignore') :
+            ratio = (counts @ flat).reshape(len(counts), n_thr, n_bins) / (counts @ total)[:, None, :]
+        vals[:, start:start + len(counts)] = ratio.transpose(1, 0, 2)
+    return vals
 
 @click.command()
 @click.option('-m', '--metadata')
 @click.option('-n', '--nwk')
 @click.option('-p', '--prefix')
-def main(prefix, metadata, nwk) :
-    meta = pd.read_csv(metadata, sep='\t', header=0)
-    samples = {}
-    for id, cohort, individual, day, dtype in meta.loc[meta['Disease type'] != 'before_FMT', ['ID', 'Cohort', 'individual', 'Day', 'Disease type']].values :
-        samples[id] = [(cohort, individual), day, dtype, cohort]
-
-    tre = ete3.Tree(nwk, format=1)
-    data = get_distance(tre, samples)
-    print(f'Prefix,Cohort,Num_individuals,delta_Date,mean_Persistence,median,2.5%,25%,75%,97.5%')
+@click.option('-r', '--replicates', default=3000, type=int, help='Number of bootstrap replicates')
+@click.option('-s', '--seed', default=None, type=int, help='Random seed of the bootstrap')
+@click.option('--threshold', default=0.001, type=float, help='Distance threshold for a persisting strain')
+@click.option('--thresholds', default=None, help='Comma-separated thresholds, evaluated from one traversal (adds a Threshold column)')
+@click.option('--threshold-grid', default=None, help='Log-spaced thresholds as "min,max,n", combined with --thresholds')
+@click.option('--tree-cache', envvar='FMT_TREE_CACHE', default=None, help='Directory for the binary cache of parsed trees')
+@click.option('--distance-store', envvar='FMT_DISTANCE_STORE', default=None, help='Directory of stored per-tree pair distances, filled on first use')
+def main(prefix, metadata, nwk, replicates, seed, threshold, thresholds, threshold_grid, tree_cache, distance_store) :
+    try :
+        thresholds = parse_thresholds(threshold, thresholds, threshold_grid)
+    except ValueError as e :
+        raise click.BadParameter(str(e))
+    meta = load_metadata(metadata)
+    if distance_store :
+        data = stored_distance(PairDistanceStore(distance_store, tree_cache), nwk, meta)
+    else :
+        data = get_distance(load_tree(nwk, tree_cache), meta)
+    rng = np.random.default_rng(seed)
+    if len(thresholds) == 1 :
+        print(f'Prefix,Cohort,Num_individuals,delta_Date,mean_Persistence,median,2.5%,25%,75%,97.5%')
+    else :
+        print(f'Prefix,Cohort,Threshold,Num_individuals,delta_Date,mean_Persistence,median,2.5%,25%,75%,97.5%')
     for cohort, individuals in sorted(data.items()) :
-        individuals = np.array(list(individuals.values()))
-        indicies = np.random.choice(len(individuals), len(individuals)*3000).reshape([3000, len(individuals)])
-        results = collections.defaultdict(list)
-        for idx in indicies :
-            res = collections.defaultdict(list)
-            for idv in individuals[idx] : 
-                res[999999999].append(min(idv.values())<=0.001)
-                for dates, dist in idv.items() :
-                    dc = np.power(2, int(np.log2(dates[1] - dates[0])))
-                    res[dc].append(dist <= 0.001)
-            for dates, dists in res.items() :
-                results[dates].append(np.average(dists))
-        for dates, vals in sorted(results.items()) :
-            qs = np.quantile(vals, [0.025, 0.25, 0.5, 0.75, 0.975])
-            if dates == 999999999 :
-                dates = 'SUM'
-            print(f'{prefix},{cohort},{len(individuals)},{dates},{np.mean(vals):.2f},{qs[2]:.2f},{qs[0]:.2f},{qs[1]:.2f},{qs[3]:.2f},{qs[4]:.2f}')
-
+        # sorted, so that a seed reproduces the same replicates
+        bins, shared, total = persistence_counts([individuals[k] for k in sorted(individuals)], thresholds)
+        vals = bootstrap(shared, total, replicates, rng)
+        observed = ~np.all(np.isnan(vals[0]), 0)
+        means = np.nanmean(vals[:, :, observed], 1)
+        qs = np.nanquantile(vals[:, :, observed], [0.025, 0.25, 0.5, 0.75, 0.975], axis=1)
+        for t, thr in enumerate(thresholds) :
+            label = f'{cohort}' if len(thresholds) == 1 else f'{cohort},{thr:g}'
+            for k, dates in enumerate(np.array(bins, dtype=object)[observed]) :
+                print(f'{prefix},{label},{len(individuals)},{dates},{means[t, k]:.2f},{qs[2, t, k]:.2f},{qs[0, t, k]:.2f},{qs[1, t, k]:.2f},{qs[3, t, k]:.2f},{qs[4, t, k]:.2f}')
 
 
 if __name__ == '__main__' :
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,115 @@
+import sys
+import click
+import numpy as np
+import pandas as pd
+from individual_lineage_genotype import HEALTHY, DISEASE, MISSING, feature_table
+from individual_lineage_tracking import conv
+from sample_metadata import load_metadata
+
+# Genotype byte -> int8 code; anything else is rejected
+_INVALID = 100
+_LUT = np.full(256, _INVALID, dtype=np.int8)
+_LUT[ord('H')], _LUT[ord('D')], _LUT[ord('-')] = HEALTHY, DISEASE, MISSING
+
+def read_genotypes(path):
+    """Read a genotype table of individual_lineage_genotype.py (wide, or --format long) as
+    (int8 species x samples matrix, species, samples). The wide table is streamed one species
+    at a time, each line being decoded straight from its bytes, so only the int8 matrix is
+    ever held in memory."""
+    with open(path, 'rb') as fin:
+        header = fin.readline().rstrip(b'\r\n').split(b'\t')
+        if header == [b'species', b'sample', b'genotype']:
+            calls = pd.read_csv(path, sep='\t', dtype=str, keep_default_na=False)
+            codes = _LUT[np.frombuffer(''.join(calls['genotype']).encode(), dtype=np.uint8)] if len(calls) else np.empty(0, dtype=np.int8)
+            if len(codes) != len(calls) or (codes == _INVALID).any():
+                raise ValueError(f'{path}: genotypes must be H, D or -')
+            return feature_table(calls.assign(genotype=codes))
+
+        samples = [s.decode() for s in header[1:]]
+        n = len(samples)
+        species, rows = [], []
+        for line in fin:
+            line = line.rstrip(b'\r\n')
+            if not line:
+                continue
+            name, _, cells = line.partition(b'\t')
+            raw = np.frombuffer(cells, dtype=np.uint8)
+            # single-character cells: genotypes at even offsets, tabs in between
+            if len(raw) == 2 * n - 1 and (raw[1::2] == ord('\t')).all():
+                codes = _LUT[raw[::2]]
+            else:
+                codes = _LUT[np.frombuffer(cells.replace(b'\t', b''), dtype=np.uint8)]
+            if len(codes) != n or (codes == _INVALID).any():
+                raise ValueError(f'{path}: malformed row for {name.decode()}')
+            species.append(name.decode())
+            rows.append(codes)
+    matrix = np.vstack(rows) if rows else np.empty((0, n), dtype=np.int8)
+    return matrix, species, samples
+
+def health_scores(matrix):
+    """Per sample, the number of H/D calls and the proportion of them that are H"""
+    calls = (matrix != MISSING).sum(0)
+    healthy = (matrix == HEALTHY).sum(0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return calls, np.where(calls > 0, healthy / calls, np.nan)
+
+def loco_scores(matrix, cohorts, status):
+    """Leave-one-cohort-out rescoring: for each cohort, every species is re-oriented on the
+    other cohorts only. A species is kept if its H-called and D-called samples there have
+    different healthy rates, and its calls are flipped if D-called samples are healthier;
+    the held-out samples are then scored on the kept species. Returns (calls, proportion)."""
+    is_h, is_d = (matrix == HEALTHY).astype(np.float64), (matrix == DISEASE).astype(np.float64)
+    calls, proportion = np.zeros(matrix.shape[1], dtype=np.int64), np.full(matrix.shape[1], np.nan)
+    known = ~np.isnan(status)
+    for cohort in pd.unique(cohorts[known]):
+        train = known & (cohorts != cohort)
+        test = cohorts == cohort
+        n_h, n_d = is_h[:, train].sum(1), is_d[:, train].sum(1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            rate_h = is_h[:, train] @ status[train] / n_h
+            rate_d = is_d[:, train] @ status[train] / n_d
+        keep = (n_h > 0) & (n_d > 0) & (rate_h != rate_d)
+        flip = rate_h < rate_d
+        h, d = is_h[keep][:, test], is_d[keep][:, test]
+        healthy = np.where(flip[keep, None], d, h).sum(0)
+        calls[test] = (h + d).sum(0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            proportion[test] = np.where(calls[test] > 0, healthy / calls[test], np.nan)
+    return calls, proportion
+
+def write_scores(output, samples, cohorts, status, calls, proportion, sep):
+    """Write the table roc.py reads; samples without metadata or without any call are left out"""
+    scores = pd.DataFrame({'sample': samples, 'cohort': cohorts, 'status_binary': status,
+                           'proportion_healthy': proportion, 'calls': calls})
+    usable = scores['status_binary'].notna() & (scores['calls'] > 0)
+    scores = scores[usable].astype({'status_binary': np.int64})
+    scores.to_csv(output, sep=sep, index=False)
+    return len(scores), int((~usable).sum())
+
+@click.command()
+@click.option('-i', '--input', 'input_file', required=True, help='Genotype table from individual_lineage_genotype.py')
+@click.option('-m', '--metadata', required=True, help='Metadata TSV with ID, Cohort and Disease type')
+@click.option('-o', '--output', required=True, help='Per-sample scores, in the format roc.py reads')
+@click.option('--loco-output', default=None, help='Also write leave-one-cohort-out scores to this file')
+@click.option('--sep', default=',', help='Column separator of the outputs (roc.py reads "," by default)')
+def main(input_file, metadata, output, loco_output, sep):
+    """Per-sample proportion of healthy lineage genotypes, joined with cohort and health status"""
+    matrix, species, samples = read_genotypes(input_file)
+
+    # healthy & responder are status 1, before_FMT & non-responder 0, as in the lineage tracking
+    meta = load_metadata(metadata)
+    rows = meta.rows(samples)
+    cohorts = np.where(rows >= 0, meta.column('Cohort', rows), np.nan)
+    status = np.append(meta.lookup('Disease type', {k: float(v == 'H') for k, v in conv.items()}, np.nan), np.nan)[rows]
+
+    calls, proportion = health_scores(matrix)
+    n_written, n_dropped = write_scores(output, samples, cohorts, status, calls, proportion, sep)
+    print(f'Scored {n_written} samples on {len(species)} species ({n_dropped} without metadata or calls left out)', file=sys.stderr)
+
+    if loco_output:
+        calls, proportion = loco_scores(matrix, cohorts, status)
+        n_written, n_dropped = write_scores(loco_output, samples, cohorts, status, calls, proportion, sep)
+        print(f'Scored {n_written} samples leaving their cohort out ({n_dropped} left out)', file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
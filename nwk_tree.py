@@ -0,0 +1,155 @@
+import os, re, hashlib
+import numpy as np
+from atomic_write import atomic_write
+
+# Parsed trees are flat arrays in preorder (node 0 is the root), so the subtree of node i
+# is the contiguous range [i, i + size[i]) and every child has a larger index than its parent.
+FIELDS = ('parent', 'dist', 'size', 'postorder', 'child_ptr', 'child_idx', 'names', 'samples', 'low_qual')
+
+_TOKEN = re.compile(r"'(?:[^']|'')*'|\[[^\]]*\]|[(),;]|[^(),;\['\s]+|\s+")
+
+
+class NwkTree(object):
+    """Array-backed Newick tree.
+
+    parent    : parent index per node (-1 for the root)
+    dist      : branch length per node (1.0 when missing, 0.0 for a root without one, as in ete3)
+    size      : number of nodes in the subtree rooted at each node
+    postorder : node indices in postorder, children in file order
+    child_ptr, child_idx : children of node i are child_idx[child_ptr[i]:child_ptr[i+1]]
+    names     : node names (format=1, internal node names kept)
+    samples   : first '|' field of leaf names ('' for internal nodes)
+    low_qual  : leaf names containing 'low_qual'
+    """
+    __slots__ = FIELDS
+
+    def __init__(self, **arrays) :
+        for key in FIELDS :
+            setattr(self, key, arrays[key])
+
+    def __len__(self) :
+        return len(self.parent)
+
+    @property
+    def is_leaf(self) :
+        return self.size == 1
+
+    def children(self, i) :
+        return self.child_idx[self.child_ptr[i]:self.child_ptr[i+1]]
+
+    def leaves(self, i=0) :
+        """Leaf indices under node i, in preorder"""
+        return i + np.flatnonzero(self.size[i:i+self.size[i]] == 1)
+
+    def leaf_lengths(self) :
+        """Leaf branch lengths as used for strain distances: low_qual leaves keep the
+        full length, other leaves a quarter of it (0 for internal nodes)"""
+        return np.where(self.size == 1, np.where(self.low_qual, self.dist, self.dist/4), 0.)
+
+
+def parse_newick(text) :
+    """Parse a Newick string (ete3 format=1) into an NwkTree"""
+    parent, labels = [], []
+    stack, cur, expect_child = [], None, False
+    for m in _TOKEN.finditer(text) :
+        tok = m.group()
+        if tok == '(' :
+            parent.append(stack[-1] if stack else -1)
+            labels.append([])
+            stack.append(len(parent) - 1)
+            cur, expect_child = None, True
+        elif tok == ',' or tok == ')' :
+            if not stack :
+                raise ValueError(f'Malformed newick: unexpected "{tok}"')
+            if expect_child :
+                raise ValueError('Malformed newick: empty leaf node found')
+            if tok == ',' :
+                cur, expect_child = None, True
+            else :
+                cur, expect_child = stack.pop(), False
+        elif tok == ';' :
+            break
+        elif tok[0] == '[' or tok.isspace() :
+            continue
+        else :
+            if cur is None :
+                if not stack :
+                    if parent :
+                        raise ValueError(f'Malformed newick: text after the root "{tok}"')
+                    # single-node tree
+                    parent.append(-1)
+                    labels.append([])
+                    cur = 0
+                else :
+                    parent.append(stack[-1])
+                    labels.append([])
+                    cur = len(parent) - 1
+            labels[cur].append(tok)
+            expect_child = False
+    if stack or not parent :
+        raise ValueError('Malformed newick: unbalanced parentheses')
+
+    n = len(parent)
+    names, dist = [], np.ones(n)
+    for i, label in enumerate(labels) :
+        label = ''.join(label)
+        if label.endswith("'") :
+            names.append(label)
+            continue
+        name, sep, length = label.rpartition(':')
+        if sep :
+            names.append(name)
+            dist[i] = float(length)
+        else :
+            names.append(label)
+            if i == 0 :
+                dist[i] = 0.
+    parent = np.array(parent, dtype=np.int32)
+
+    size = np.ones(n, dtype=np.int32)
+    par = parent.tolist()
+    for i in range(n-1, 0, -1) :
+        size[par[i]] += size[i]
+    idx = np.arange(n, dtype=np.int32)
+    postorder = np.lexsort((-idx, idx + size)).astype(np.int32)
+    child_idx = idx[1:][np.argsort(parent[1:], kind='stable')]
+    child_ptr = np.zeros(n + 1, dtype=np.int32)
+    np.cumsum(np.bincount(parent[1:], minlength=n), out=child_ptr[1:])
+
+    is_leaf = size == 1
+    names = np.array(names, dtype=str)
+    samples = np.array([name.split('|')[0] if leaf else '' for name, leaf in zip(names.tolist(), is_leaf.tolist())], dtype=str)
+    low_qual = is_leaf & (np.char.find(names, 'low_qual') >= 0)
+    return NwkTree(parent=parent, dist=dist, size=size, postorder=postorder, child_ptr=child_ptr,
+                   child_idx=child_idx, names=names, samples=samples, low_qual=low_qual)
+
+
+def cache_key(path) :
+    """Cache key of a tree file: its absolute path, mtime and size"""
+    st = os.stat(path)
+    return hashlib.sha1(f'{os.path.abspath(path)}\0{st.st_mtime_ns}\0{st.st_size}'.encode()).hexdigest()
+
+
+def load_tree(path, cache_dir=None) :
+    """Load a Newick file as an NwkTree.
+    With cache_dir, the parsed arrays are stored as .npy files under a key of path, mtime
+    and size, and later loads memory-map them instead of parsing the file again."""
+    if not cache_dir :
+        with open(path) as fin :
+            return parse_newick(fin.read())
+
+    key = cache_key(path)
+    entry = os.path.join(cache_dir, key[:2], key)
+    if os.path.isdir(entry) :
+        try :
+            return NwkTree(**{f: np.load(os.path.join(entry, f + '.npy'), mmap_mode='r') for f in FIELDS})
+        except (OSError, ValueError) :
+            pass
+    with open(path) as fin :
+        tree = parse_newick(fin.read())
+    def write(tmp) :
+        for f in FIELDS :
+            np.save(os.path.join(tmp, f + '.npy'), getattr(tree, f))
+    # fails when another process filled the entry first, or the cache is not writable
+    atomic_write(entry, write, directory=True)
+    return tree
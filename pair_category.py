@@ -0,0 +1,116 @@
+import numpy as np
+import pandas as pd
+
+CATEGORIES = ['healthy_same_individual', 'healthy_different_individuals',
+              'same_patients', 'different_patients_same_donor', 'different_patients',
+              'before_after_FMT_same_responder', 'before_after_FMT_same_non_responder',
+              'patient_vs_its_donor_responder', 'patient_vs_its_donor_non_responder',
+              'other']
+category_codes = {c: i for i, c in enumerate(CATEGORIES)}
+
+# 'Disease type' codes; anything else (including missing values) is OTHER
+HEALTHY, BEFORE_FMT, RESPONDER, NON_RESPONDER, OTHER = range(5)
+type_codes = {'healthy': HEALTHY, 'before_FMT': BEFORE_FMT, 'responder': RESPONDER, 'non-responder': NON_RESPONDER}
+
+
+def categorize_pair(row1, row2):
+    """Categorize sample pair based on metadata"""
+    type1 = row1['Disease type']
+    type2 = row2['Disease type']
+
+    if type1 == 'healthy' and type2 == 'healthy':
+        if row1['individual'] == row2['individual']:
+            return 'healthy_same_individual'
+        return 'healthy_different_individuals'
+
+    if type1 != 'healthy' and type2 != 'healthy':
+        if type1 != 'before_FMT' and type2 != 'before_FMT':
+            if row1['individual'] == row2['individual']:
+                return 'same_patients'
+            if row1['donor'] == row2['donor']:
+                return 'different_patients_same_donor'
+            if row1['donor'] != row2['donor']:
+                return 'different_patients'
+        elif row1['individual'] == row2['individual'] and (type1 != 'before_FMT' or type2 != 'before_FMT'):
+            if row1['Disease type'] == 'responder' or row2['Disease type'] == 'responder':
+                return 'before_after_FMT_same_responder'
+            elif row1['Disease type'] == 'non-responder' or row2['Disease type'] == 'non-responder':
+                return 'before_after_FMT_same_non_responder'
+            # return 'before_after_FMT_same_individual'
+
+    # One healthy, one patient
+    if type1 != 'healthy':
+        patient, healthy = row1, row2
+    else:
+        patient, healthy = row2, row1
+
+    if patient['donor'] == healthy['individual'] and patient['Disease type'] != 'before_FMT':
+        if patient['Disease type'] == 'responder':
+            return 'patient_vs_its_donor_responder'
+        elif patient['Disease type'] == 'non-responder':
+            return 'patient_vs_its_donor_non_responder'
+
+    return 'other'  # Default category for unmatched pairs
+
+
+def encode_metadata(meta, rows=None):
+    """The codes categorize_pairs needs, from a sample_metadata.Metadata, one entry per row
+    (or per entry of rows). 'individual' and 'donor' already share one vocabulary there;
+    missing values are -1 and never equal to anything, as NaN in categorize_pair."""
+    def take(codes):
+        return codes if rows is None else codes[rows]
+    return {'type': take(meta.lookup('Disease type', type_codes, OTHER)).astype(np.int8),
+            'individual': take(meta.codes['individual']), 'donor': take(meta.codes['donor'])}
+
+
+def categorize_pairs(codes, i, j):
+    """Category codes (indices into CATEGORIES) of the sample pairs (i[k], j[k]),
+    where i and j index the rows encoded by encode_metadata; same rules as categorize_pair"""
+    t1, t2 = codes['type'][i], codes['type'][j]
+    ind1, ind2 = codes['individual'][i], codes['individual'][j]
+    donor1, donor2 = codes['donor'][i], codes['donor'][j]
+    def equal(a, b):
+        return (a == b) & (a >= 0)
+
+    cat = np.full(len(t1), category_codes['other'], dtype=np.int8)
+    h1, h2 = t1 == HEALTHY, t2 == HEALTHY
+    b1, b2 = t1 == BEFORE_FMT, t2 == BEFORE_FMT
+    same_ind = equal(ind1, ind2)
+    open_ = np.ones(len(t1), dtype=bool)
+
+    m = h1 & h2
+    cat[m & same_ind] = category_codes['healthy_same_individual']
+    cat[m & ~same_ind] = category_codes['healthy_different_individuals']
+    open_ &= ~m
+
+    m = ~h1 & ~h2 & ~b1 & ~b2
+    same_donor = equal(donor1, donor2)
+    cat[m & same_ind] = category_codes['same_patients']
+    cat[m & ~same_ind & same_donor] = category_codes['different_patients_same_donor']
+    cat[m & ~same_ind & ~same_donor] = category_codes['different_patients']
+    open_ &= ~m
+
+    m = ~h1 & ~h2 & (b1 | b2) & ~(b1 & b2) & same_ind
+    resp = (t1 == RESPONDER) | (t2 == RESPONDER)
+    non_resp = (t1 == NON_RESPONDER) | (t2 == NON_RESPONDER)
+    cat[m & resp] = category_codes['before_after_FMT_same_responder']
+    cat[m & ~resp & non_resp] = category_codes['before_after_FMT_same_non_responder']
+    open_ &= ~(m & (resp | non_resp))
+
+    # One healthy, one patient (the first sample is the "patient" unless it is healthy)
+    p_type = np.where(h1, t2, t1)
+    m = open_ & equal(np.where(h1, donor2, donor1), np.where(h1, ind1, ind2))
+    cat[m & (p_type == RESPONDER)] = category_codes['patient_vs_its_donor_responder']
+    cat[m & (p_type == NON_RESPONDER)] = category_codes['patient_vs_its_donor_non_responder']
+    return cat
+
+
+def pair_labels(values, i, j):
+    """'a|b' labels of the pairs (values[i[k]], values[j[k]]) with a <= b, built once per
+    distinct pair of values (missing values are empty strings)"""
+    codes, uniques = pd.factorize(pd.Series(values, dtype=object).fillna('').astype(str), sort=True)
+    lo, hi = np.minimum(codes[i], codes[j]), np.maximum(codes[i], codes[j])
+    keys, inverse = np.unique(lo.astype(np.int64) * len(uniques) + hi, return_inverse=True)
+    uniques = np.asarray(uniques, dtype=object)
+    labels = uniques[keys // max(len(uniques), 1)] + '|' + uniques[keys % max(len(uniques), 1)]
+    return labels[inverse.reshape(-1)]
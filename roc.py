@@ -1,81 +1,168 @@
 import pandas as pd
 import numpy as np
+import click
+import multiprocessing
 import matplotlib.pyplot as plt
 from sklearn.metrics import roc_curve, auc
 from matplotlib.backends.backend_pdf import PdfPages
+from scipy.stats import norm, rankdata
 
-def calculate_roc_auc(df, cohort_name=None):
-    """Calculate ROC curve and AUC for a given cohort"""
-    if cohort_name:
-        cohort_df = df[df['cohort'] == cohort_name]
-    else:
-        cohort_df = df  # All cohorts
-    
-    fpr, tpr, thresholds = roc_curve(cohort_df['status_binary'], 
-                                     cohort_df['proportion_healthy'])
+# Define colors and markers for each cohort; other cohorts get the default color cycle
+cohort_styles = {
+    'rCDI': ('firebrick', 'o'),
+    'IBS': ('darkorange', 's'),
+    'LUAD': ('forestgreen', '^'),
+    'MEL': ('darkviolet', 'd')
+}
+
+def calculate_roc_auc(status, score):
+    """Calculate ROC curve and AUC for the samples of a cohort"""
+    fpr, tpr, thresholds = roc_curve(status, score)
     roc_auc = auc(fpr, tpr)
-    return fpr, tpr, roc_auc, len(cohort_df)
+    return fpr, tpr, roc_auc, len(status)
+
+def delong(status, score):
+    """AUC and its DeLong variance in O(n log n), from the midranks of the positives, the
+    negatives and both together (Sun & Xu, 2014); (nan, nan) without both classes"""
+    pos, neg = score[status == 1], score[status == 0]
+    m, n = len(pos), len(neg)
+    if m == 0 or n == 0:
+        return np.nan, np.nan
+    tz = rankdata(np.concatenate([pos, neg]))
+    v01 = (tz[:m] - rankdata(pos)) / n
+    v10 = 1. - (tz[m:] - rankdata(neg)) / m
+    auc_value = v01.mean()
+    var = (v01.var(ddof=1) / m if m > 1 else 0.) + (v10.var(ddof=1) / n if n > 1 else 0.)
+    return auc_value, var
+
+def bootstrap_aucs(status, score, strata, replicates, seed_seq):
+    """AUCs of replicates resampled with replacement within each stratum, the positives and
+    negatives being separate strata so that every replicate keeps both classes. All replicates
+    are ranked at once, the AUC being the Mann-Whitney statistic of each row."""
+    rng = np.random.default_rng(seed_seq)
+    order = np.lexsort((strata, -status))
+    status, score, strata = status[order], score[order], strata[order]
+    keys = strata.astype(np.int64) * 2 + status
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    sizes = np.diff(np.r_[starts, len(keys)])
+    # columns stay in stratum order, so the positives are always the first m columns
+    idx = np.concatenate([start + rng.integers(0, size, (replicates, size)) for start, size in zip(starts, sizes)], 1)
+    m, n = int(status.sum()), int(len(status) - status.sum())
+    ranks = rankdata(score[idx], axis=1)
+    return (ranks[:, :m].sum(1) - m * (m + 1) / 2.) / (m * n)
+
+def _bootstrap_task(args):
+    return bootstrap_aucs(*args)
+
+def bootstrap_ci(groups, replicates, seed, level, workers, cells=5000000):
+    """Percentile bootstrap intervals of the AUC of every group {name: (status, score, strata)}.
+    Replicates are drawn in blocks of about cells resampled values, each block with its own
+    child seed of seed, so the result does not depend on the number of workers."""
+    tasks, owners = [], []
+    root = np.random.SeedSequence(seed)
+    for name, (status, score, strata) in groups.items():
+        if status.min() == status.max():
+            continue
+        block = max(1, min(1000, cells // len(status)))
+        for start, child in zip(range(0, replicates, block), root.spawn(-(-replicates // block))):
+            tasks.append((status, score, strata, min(block, replicates - start), child))
+            owners.append(name)
+    if workers > 1 and len(tasks) > 1:
+        with multiprocessing.Pool(workers) as pool:
+            results = pool.map(_bootstrap_task, tasks)
+    else:
+        results = list(map(_bootstrap_task, tasks))
+    aucs = {}
+    for name, values in zip(owners, results):
+        aucs.setdefault(name, []).append(values)
+    tail = (1. - level) / 2. * 100
+    return {name: tuple(np.percentile(np.concatenate(values), [tail, 100 - tail])) for name, values in aucs.items()}
 
-# Load data
-df = pd.read_csv('input_data.tsv', sep=',')  # Update with your filename
+@click.command()
+@click.option('-i', '--input', 'input_file', default='input_data.tsv', help='Table with cohort, status_binary and proportion_healthy columns')
+@click.option('--sep', default=',', help='Column separator of the input')
+@click.option('-o', '--output', default='roc_curves.pdf', help='PDF of the ROC curves')
+@click.option('-t', '--table', default=None, help='Optional TSV of the AUCs and their confidence intervals')
+@click.option('-b', '--bootstrap', default=0, type=int, help='Bootstrap replicates of the AUC confidence intervals (0: DeLong only)')
+@click.option('-s', '--seed', default=None, type=int, help='Random seed of the bootstrap')
+@click.option('--level', default=0.95, type=float, help='Confidence level')
+@click.option('--workers', default=1, type=int, help='Processes running bootstrap replicates')
+def main(input_file, sep, output, table, bootstrap, seed, level, workers):
+    """ROC curves and AUCs per cohort and for all cohorts combined"""
+    # Load data, grouped by cohort once
+    df = pd.read_csv(input_file, sep=sep)
+    status = df['status_binary'].to_numpy(dtype=np.int64)
+    score = df['proportion_healthy'].to_numpy(dtype=np.float64)
+    cohort_codes, cohort_names = pd.factorize(df['cohort'])
+    groups = {'All Cohorts': (status, score, cohort_codes)}
+    cohorts = [c for c in cohort_styles if c in set(cohort_names)] + sorted(c for c in cohort_names if c not in cohort_styles)
+    for cohort in cohorts:
+        rows = cohort_codes == cohort_names.get_loc(cohort)
+        groups[cohort] = (status[rows], score[rows], np.zeros(rows.sum(), dtype=np.int64))
+
+    z = norm.ppf(0.5 + level / 2.)
+    boot = bootstrap_ci(groups, bootstrap, seed, level, workers) if bootstrap > 0 else {}
+    results = []
+    for name, (s, x, strata) in groups.items():
+        auc_value, var = delong(s, x)
+        se = np.sqrt(var)
+        results.append({'cohort': name, 'samples': len(s), 'auc': auc_value, 'delong_se': se,
+                        'delong_low': max(auc_value - z * se, 0.), 'delong_high': min(auc_value + z * se, 1.),
+                        'bootstrap_low': boot.get(name, (np.nan, np.nan))[0], 'bootstrap_high': boot.get(name, (np.nan, np.nan))[1]})
+    results = pd.DataFrame(results).set_index('cohort')
+
+    # Create PDF for output
+    with PdfPages(output) as pdf:
+        plt.figure(figsize=(10, 8))
+        for name, (s, x, strata) in groups.items():
+            if s.min() == s.max():
+                continue
+            fpr, tpr, auc_value, n = calculate_roc_auc(s, x)
+            if name == 'All Cohorts':
+                # Plot ROC for all cohorts combined
+                plt.plot(fpr, tpr, color='navy', lw=2,
+                         label=f'All Cohorts (AUC = {auc_value:.2f}, N={n})')
+            else:
+                color, marker = cohort_styles.get(name, (None, None))
+                plt.plot(fpr, tpr, color=color, lw=1.5,
+                         marker=marker, markevery=0.1, markersize=8,
+                         label=f'{name} (AUC = {auc_value:.2f}, N={n})')
+
+        # Format plot
+        plt.plot([0, 1], [0, 1], 'k--', lw=1)  # Diagonal line
+        plt.xlim([0.0, 1.0])
+        plt.ylim([0.0, 1.05])
+        plt.xlabel('False Positive Rate', fontsize=12)
+        plt.ylabel('True Positive Rate', fontsize=12)
+        plt.title('ROC Curves by Cohort', fontsize=14)
+        plt.legend(loc="lower right", fontsize=10)
+        plt.grid(True, alpha=0.3)
+
+        # Add AUC table, cohorts first and the overall AUC last
+        table_data = [[name, f'{results.at[name, "auc"]:.3f}', results.at[name, 'samples']] for name in cohorts + ['All Cohorts']]
+        col_labels = ['Cohort', 'AUC', 'Samples']
+        plt.table(cellText=table_data,
+                  colLabels=col_labels,
+                  cellLoc='center',
+                  loc='lower left',
+                  bbox=[0.15, 0.55, 0.25, 0.35])
+
+        # Save to PDF
+        pdf.savefig(bbox_inches='tight')
+        plt.close()
+
+    if table:
+        results.to_csv(table, sep='\t')
 
-# Create PDF for output
-with PdfPages('roc_curves.pdf') as pdf:
-    plt.figure(figsize=(10, 8))
-    
-    # Plot ROC for all cohorts combined
-    fpr_all, tpr_all, auc_all, n_all = calculate_roc_auc(df)
-    plt.plot(fpr_all, tpr_all, color='navy', lw=2, 
-             label=f'All Cohorts (AUC = {auc_all:.2f}, N={n_all})')
-    
-    # Define colors and markers for each cohort
-    cohort_styles = {
-        'rCDI': ('firebrick', 'o'),
-        'IBS': ('darkorange', 's'),
-        'LUAD': ('forestgreen', '^'),
-        'MEL': ('darkviolet', 'd')
-    }
-    
-    # Plot ROC for each cohort
-    for cohort, (color, marker) in cohort_styles.items():
-        fpr_cohort, tpr_cohort, auc_cohort, n_cohort = calculate_roc_auc(df, cohort)
-        plt.plot(fpr_cohort, tpr_cohort, color=color, lw=1.5, 
-                 marker=marker, markevery=0.1, markersize=8,
-                 label=f'{cohort} (AUC = {auc_cohort:.2f}, N={n_cohort})')
-    
-    # Format plot
-    plt.plot([0, 1], [0, 1], 'k--', lw=1)  # Diagonal line
-    plt.xlim([0.0, 1.0])
-    plt.ylim([0.0, 1.05])
-    plt.xlabel('False Positive Rate', fontsize=12)
-    plt.ylabel('True Positive Rate', fontsize=12)
-    plt.title('ROC Curves by Cohort', fontsize=14)
-    plt.legend(loc="lower right", fontsize=10)
-    plt.grid(True, alpha=0.3)
-    
-    # Add AUC table
-    table_data = []
-    for cohort in cohort_styles.keys():
-        _, _, auc_val, n_val = calculate_roc_auc(df, cohort)
-        table_data.append([cohort, f'{auc_val:.3f}', n_val])
-    
-    # Add overall AUC
-    table_data.append(['All Cohorts', f'{auc_all:.3f}', n_all])
-    
-    # Create table
-    col_labels = ['Cohort', 'AUC', 'Samples']
-    plt.table(cellText=table_data,
-              colLabels=col_labels,
-              cellLoc='center',
-              loc='lower left',
-              bbox=[0.15, 0.55, 0.25, 0.35])
-    
-    # Save to PDF
-    pdf.savefig(bbox_inches='tight')
-    plt.close()
-    
     # Print AUC values to console
     print("AUC Values:")
     print("-----------")
-    for row in table_data:
-        print(f"{row[0]}: {row[1]} (N={row[2]})")
\ No newline at end of file
+    for name in cohorts + ['All Cohorts']:
+        row = results.loc[name]
+        line = f"{name}: {row['auc']:.3f} (N={int(row['samples'])}; DeLong {level:.0%} CI {row['delong_low']:.3f}-{row['delong_high']:.3f}"
+        if bootstrap > 0:
+            line += f"; bootstrap {row['bootstrap_low']:.3f}-{row['bootstrap_high']:.3f}"
+        print(line + ")")
+
+if __name__ == '__main__':
+    main()
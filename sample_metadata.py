@@ -0,0 +1,113 @@
+import os
+import numpy as np
+import pandas as pd
+from atomic_write import atomic_write
+
+# Columns that are dictionary-encoded; 'individual' and 'donor' share one vocabulary, since a
+# donor is matched against individuals
+COLUMNS = ('Sample_ID', 'Cohort', 'individual', 'donor', 'Day', 'Disease type')
+_PEOPLE = ('individual', 'donor')
+# Bump when the sidecar layout changes
+_CACHE_VERSION = 1
+
+
+class Metadata(object):
+    """Integer-encoded metadata: one row per distinct ID (the first occurrence), sorted by ID.
+
+    ids    : sample IDs of the rows
+    codes  : column -> int32 codes per row, -1 for missing values (or a missing column);
+             vocabularies are sorted, so codes compare like the values they stand for
+    values : column -> vocabulary, i.e. values[column][codes[column]] decodes a column
+    """
+    __slots__ = ('ids', 'codes', 'values', '_index')
+
+    def __init__(self, ids, codes, values) :
+        self.ids, self.codes, self.values = ids, codes, values
+        self._index = None
+
+    def __len__(self) :
+        return len(self.ids)
+
+    def __getstate__(self) :
+        # workers rebuild the ID lookup themselves instead of unpickling it
+        return self.ids, self.codes, self.values
+
+    def __setstate__(self, state) :
+        self.ids, self.codes, self.values = state
+        self._index = None
+
+    @property
+    def index(self) :
+        """ID -> row"""
+        if self._index is None :
+            self._index = {s: i for i, s in enumerate(self.ids.tolist())}
+        return self._index
+
+    def rows(self, names) :
+        """Rows of sample names (e.g. tree leaf samples), -1 for names not in the metadata"""
+        index = self.index
+        return np.fromiter((index.get(s, -1) for s in np.asarray(names).tolist()), dtype=np.int64, count=len(names))
+
+    def column(self, name, rows=None) :
+        """Decoded values of a column (NaN where missing) for all rows or the given rows"""
+        codes = self.codes[name] if rows is None else self.codes[name][rows]
+        values = np.asarray(self.values[name], dtype=object)
+        decoded = np.full(len(codes), np.nan, dtype=object)
+        decoded[codes >= 0] = values[codes[codes >= 0]]
+        return decoded
+
+    def lookup(self, name, mapping, default=-1) :
+        """Per-row codes of a mapping of a column's values, e.g. {'healthy': 0, ...}; rows whose
+        value is missing or not in mapping get default. Costs one lookup per distinct value."""
+        table = np.array([mapping.get(v, default) for v in np.asarray(self.values[name], dtype=object).tolist()] + [default])
+        return table[self.codes[name]]
+
+    @classmethod
+    def from_frame(cls, df) :
+        """Encode a metadata DataFrame with an ID column"""
+        df = df.drop_duplicates('ID', keep='first').sort_values('ID', kind='stable')
+        codes, values = {}, {}
+        missing = pd.Series(np.nan, index=df.index, dtype=object)
+        people = pd.concat([df[c] if c in df else missing for c in _PEOPLE], ignore_index=True)
+        people = people.where(people.isna(), people.astype(str))
+        people_codes, people_values = pd.factorize(people, sort=True)
+        for k, c in enumerate(_PEOPLE) :
+            codes[c] = people_codes[k * len(df):(k + 1) * len(df)].astype(np.int32)
+            values[c] = _vocabulary(people_values)
+        for c in COLUMNS :
+            if c in _PEOPLE :
+                continue
+            column = df[c] if c in df else missing
+            column_codes, column_values = pd.factorize(column, sort=True)
+            codes[c], values[c] = column_codes.astype(np.int32), _vocabulary(column_values)
+        return cls(np.asarray(df['ID'].astype(str), dtype=str), codes, values)
+
+
+def _vocabulary(values) :
+    """Vocabulary as a plain array: numeric values stay numeric, anything else becomes str"""
+    values = np.asarray(values)
+    return values if values.dtype.kind in 'biuf' else np.asarray(values, dtype=str)
+
+
+def load_metadata(path, cache=True) :
+    """Read a metadata TSV as a Metadata. With cache, the encoded arrays are kept in a binary
+    sidecar (<path>.enc.npz) that is reused as long as the file's mtime and size match."""
+    sidecar = path + '.enc.npz'
+    st = os.stat(path)
+    stamp = np.array([_CACHE_VERSION, st.st_mtime_ns, st.st_size], dtype=np.int64)
+    if cache and os.path.isfile(sidecar) :
+        try :
+            with np.load(sidecar) as data :
+                if np.array_equal(data['stamp'], stamp) :
+                    return Metadata(data['ids'], {c: data[f'{c}.codes'] for c in COLUMNS}, {c: data[f'{c}.values'] for c in COLUMNS})
+        except (OSError, ValueError, KeyError) :
+            pass
+
+    meta = Metadata.from_frame(pd.read_csv(path, sep='\t', header=0))
+    if cache :
+        arrays = {'stamp': stamp, 'ids': meta.ids}
+        for c in COLUMNS :
+            arrays[f'{c}.codes'], arrays[f'{c}.values'] = meta.codes[c], meta.values[c]
+        # in a read-only location, go without the sidecar
+        atomic_write(sidecar, lambda fout : np.savez(fout, **arrays))
+    return meta
@@ -1,116 +1,289 @@
 import click
 import pandas as pd
 import numpy as np
-from collections import defaultdict
-from ete3 import Tree
+from scipy import sparse as sp
+from nwk_tree import load_tree
+from pair_category import CATEGORIES, encode_metadata, categorize_pairs, pair_labels
+from sample_metadata import load_metadata
+from strain_distance import parse_thresholds, content_hash, PairDistanceStore
 from pathlib import Path
-import multiprocessing
+from tree_pool import tree_pool
+from atomic_write import atomic_write
 from tqdm import tqdm
 import os
+import heapq
 
-def categorize_pair(row1, row2):
-    """Categorize sample pair based on metadata"""
-    type1 = row1['Disease type']
-    type2 = row2['Disease type']
-    
-    if type1 == 'healthy' and type2 == 'healthy':
-        if row1['individual'] == row2['individual']:
-            return 'healthy_same_individual'
-        return 'healthy_different_individuals'
-    
-    if type1 != 'healthy' and type2 != 'healthy':
-        if type1 != 'before_FMT' and type2 != 'before_FMT':
-            if row1['individual'] == row2['individual']:
-                return 'same_patients'
-            if row1['donor'] == row2['donor']:
-                return 'different_patients_same_donor'
-            if row1['donor'] != row2['donor']:
-                return 'different_patients'
-        elif row1['individual'] == row2['individual'] and (type1 != 'before_FMT' or type2 != 'before_FMT'):
-            if row1['Disease type'] == 'responder' or row2['Disease type'] == 'responder':
-                return 'before_after_FMT_same_responder'
-            elif row1['Disease type'] == 'non-responder' or row2['Disease type'] == 'non-responder':
-                return 'before_after_FMT_same_non_responder'
-            # return 'before_after_FMT_same_individual'
-    
-    # One healthy, one patient
-    if type1 != 'healthy':
-        patient, healthy = row1, row2
-    else:
-        patient, healthy = row2, row1
-    
-    if patient['donor'] == healthy['individual'] and patient['Disease type'] != 'before_FMT':
-        if patient['Disease type'] == 'responder':
-            return 'patient_vs_its_donor_responder'
-        elif patient['Disease type'] == 'non-responder':
-            return 'patient_vs_its_donor_non_responder'
-    
-    return 'other'  # Default category for unmatched pairs
-
-def get_distance(tre, samples) :
-    individual_pairs = defaultdict(lambda : defaultdict(dict))
-    for n in tre.traverse('postorder') :
-        if n.is_leaf() :
-            info = n.name.split('|')
-            if info[0] in samples :
-                n.d = [[n.name, info[0], n.dist, 0.]]
-            else :
-                n.d = []
+def distinct_sample_ids(meta) :
+    """Sample_ID code per metadata row; rows without one get a unique negative code,
+    as a missing Sample_ID never equals another"""
+    codes = meta.codes['Sample_ID'].astype(np.int64)
+    return np.where(codes >= 0, codes, -1 - np.arange(len(codes)))
+
+def get_distance(tre, meta) :
+    """Minimum tip-to-tip distance for every pair of metadata samples in an NwkTree, keyed by
+    their (row1, row2) rows in meta with row1 < row2. Subtrees keep the minimum adjusted depth
+    per sample row, which is all a pair minimum needs; samples are compared as integers."""
+    individual_pairs = {}
+    leaf_len, dist = tre.leaf_lengths().tolist(), tre.dist.tolist()
+    tip_rows, ptr, cidx = meta.rows(tre.samples).tolist(), tre.child_ptr.tolist(), tre.child_idx.tolist()
+    sample_id = distinct_sample_ids(meta).tolist()
+    d = [None] * len(leaf_len)
+    for n in tre.postorder.tolist() :
+        if ptr[n] == ptr[n+1] :
+            d[n] = {tip_rows[n]: leaf_len[n]} if tip_rows[n] >= 0 else {}
         else :
-            for i, c1 in enumerate(n.children) :
-                for j, c2 in enumerate(n.children[:i]) :
-                    if len(c1.d) and len(c2.d) :
-                        for t1 in c1.d :
-                            for t2 in c2.d :
-                                if (t1[1] != t2[1]) and (samples[t1[1]]['Sample_ID'] != samples[t2[1]]['Sample_ID']) :
-                                    dist = t1[3] + t2[3] + (t1[2] if 'low_qual' in t1[0] else t1[2]/4) + (t2[2] if 'low_qual' in t2[0] else t2[2]/4)
-                                    key = tuple(sorted([t1[1], t2[1]]))
-                                    if key not in individual_pairs or individual_pairs[key] > dist :
-                                        individual_pairs[key] = dist
-            n.d = [[d[0], d[1], d[2], d[3] + n.dist] for c in n.children for d in c.d]
+            children = cidx[ptr[n]:ptr[n+1]]
+            for i, c1 in enumerate(children) :
+                for c2 in children[:i] :
+                    for s1, d1 in d[c1].items() :
+                        for s2, d2 in d[c2].items() :
+                            if s1 != s2 and sample_id[s1] != sample_id[s2] :
+                                key = (s1, s2) if s1 < s2 else (s2, s1)
+                                if key not in individual_pairs or individual_pairs[key] > d1 + d2 :
+                                    individual_pairs[key] = d1 + d2
+            depths = {}
+            for c in children :
+                for s, depth in d[c].items() :
+                    if s not in depths or depths[s] > depth + dist[n] :
+                        depths[s] = depth + dist[n]
+                d[c] = None
+            d[n] = depths
     return individual_pairs
 
 
-def process_tree(data):
-    nwk_file, meta_dict, threshold = data
-    """Process a single tree file and return pairwise sharing results"""
-    tree_results = []
-    
+def get_close_pairs(tre, meta, threshold) :
+    """Distance-bounded get_distance: only pairs with dist <= threshold are reported.
+    Each subtree keeps its tips sorted by depth and drops tips deeper than the threshold,
+    so sibling subtrees whose minimum depths already sum above it are never enumerated
+    (assumes non-negative branch lengths). Returns the close pairs and all sample rows seen."""
+    individual_pairs = {}
+    present = set()
+    leaf_len, dist = tre.leaf_lengths().tolist(), tre.dist.tolist()
+    tip_rows, ptr, cidx = meta.rows(tre.samples).tolist(), tre.child_ptr.tolist(), tre.child_idx.tolist()
+    sample_id = distinct_sample_ids(meta).tolist()
+    d = [None] * len(leaf_len)
+    for n in tre.postorder.tolist() :
+        if ptr[n] == ptr[n+1] :
+            if tip_rows[n] >= 0 :
+                present.add(tip_rows[n])
+                d[n] = [(leaf_len[n], tip_rows[n])] if leaf_len[n] <= threshold else []
+            else :
+                d[n] = []
+        else :
+            children = cidx[ptr[n]:ptr[n+1]]
+            for i, c1 in enumerate(children) :
+                for c2 in children[:i] :
+                    if not d[c1] or not d[c2] or d[c1][0][0] + d[c2][0][0] > threshold :
+                        continue
+                    min2 = d[c2][0][0]
+                    for d1, s1 in d[c1] :
+                        if d1 + min2 > threshold :
+                            break
+                        for d2, s2 in d[c2] :
+                            if d1 + d2 > threshold :
+                                break
+                            if s1 != s2 and sample_id[s1] != sample_id[s2] :
+                                key = (s1, s2) if s1 < s2 else (s2, s1)
+                                if key not in individual_pairs or individual_pairs[key] > d1 + d2 :
+                                    individual_pairs[key] = d1 + d2
+            d[n] = [(depth + dist[n], s) for depth, s in heapq.merge(*[d[c] for c in children]) if depth + dist[n] <= threshold]
+            for c in children :
+                d[c] = None
+    return individual_pairs, present
+
+
+# Per-worker state, filled once by init_worker instead of being pickled with every task
+_meta = None
+_sample_id = None
+_prune_threshold = None
+_tree_cache = None
+_distance_store = None
+_checkpoint_dir = None
+_checkpoint_params = ''
+
+def init_worker(meta, prune_threshold=None, tree_cache=None, distance_store=None, checkpoint_dir=None, checkpoint_params=''):
+    """Receive the encoded metadata once per worker process"""
+    global _meta, _sample_id, _prune_threshold, _tree_cache, _distance_store, _checkpoint_dir, _checkpoint_params
+    _meta = meta
+    _sample_id = distinct_sample_ids(meta)
+    _prune_threshold = prune_threshold
+    _tree_cache = tree_cache
+    _distance_store = distance_store
+    _checkpoint_dir = checkpoint_dir
+    _checkpoint_params = checkpoint_params
+
+
+def pair_arrays(pairs):
+    """{(row1, row2): distance} as compact (idx1, idx2, dists) arrays"""
+    idx1 = np.fromiter((p[0] for p in pairs), dtype=np.int32, count=len(pairs))
+    idx2 = np.fromiter((p[1] for p in pairs), dtype=np.int32, count=len(pairs))
+    dists = np.fromiter(pairs.values(), dtype=np.float64, count=len(pairs))
+    return idx1, idx2, dists
+
+def tree_pairs(nwk_file):
+    """Pairwise distances of one tree as compact arrays (sample1 index, sample2 index, distance),
+    plus the sorted metadata rows present in the tree; indices refer to the metadata order.
+    Under --prune only the pairs within the threshold are returned, the pairs observed
+    together being counted from the present rows by PairAccumulator."""
+    if _distance_store is not None:
+        return stored_pairs(nwk_file)
+
+    tree = load_tree(str(nwk_file), _tree_cache)
+    if _prune_threshold is not None :
+        close_pairs, present = get_close_pairs(tree, _meta, _prune_threshold)
+        return pair_arrays(close_pairs) + (np.array(sorted(present), dtype=np.int32), )
+
+    rows = _meta.rows(tree.samples)
+    return pair_arrays(get_distance(tree, _meta)) + (np.unique(rows[rows >= 0]).astype(np.int32), )
+
+def checkpoint_path(key):
+    return os.path.join(_checkpoint_dir, 'trees', key[:2], key + '.npz')
+
+def process_tree(nwk_file):
+    """Process a single tree file, or read its checkpoint back.
+    Returns (tree file, checkpoint key, idx1, idx2, dists, present, status, error, cached).
+    A tree that fails has status 'failed', its error and empty arrays, and is not
+    checkpointed; one whose checkpoint cannot be written has status 'unsaved' and its
+    error, but its arrays are still returned and counted."""
+    key, empty = None, (np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32), np.empty(0), np.empty(0, dtype=np.int32))
     try:
-        tree = Tree(str(nwk_file), format=1)
-    except:
-        return tree_results  # Skip malformed trees
-    
-    pairs = get_distance(tree, meta_dict)
-    for (id_i, id_j), dist in pairs.items():
-        shared = 1 if dist <= threshold else 0
-        tree_results.append({
-            'sample1': id_i,
-            'sample2': id_j,
-            'distance': dist,
-            'shared': shared,
-            'tree': nwk_file.rsplit('/', 2)[-2]  # Extract tree name from path
-        })
-    
-    return tree_results
+        if _checkpoint_dir is not None:
+            key = content_hash(nwk_file, _checkpoint_params)
+            if os.path.isfile(checkpoint_path(key)):
+                try:
+                    with np.load(checkpoint_path(key)) as data:
+                        return nwk_file, key, data['idx1'], data['idx2'], data['dists'], data['present'], 'done', None, True
+                except (OSError, ValueError, KeyError):
+                    # unreadable checkpoint, e.g. from a killed run: process the tree again
+                    pass
+        idx1, idx2, dists, present = tree_pairs(nwk_file)
+    except Exception as e:
+        return (nwk_file, key) + empty + ('failed', f'{type(e).__name__}: {e}', False)
+
+    status, error = 'done', None
+    if key is not None:
+        e = atomic_write(checkpoint_path(key), lambda fout: np.savez(fout, idx1=idx1, idx2=idx2, dists=dists, present=present))
+        if e is not None:
+            # e.g. a full disk: the tree still counts, and the next run processes it again
+            status, error = 'unsaved', f'{type(e).__name__}: {e}'
+    return nwk_file, key, idx1, idx2, dists, present, status, error, False
+
+def stored_pairs(nwk_file):
+    """tree_pairs read from the distance store: pairs of metadata samples with different
+    Sample_IDs (within the threshold under --prune) and the rows present in the tree"""
+    names, i, j, dists = _distance_store.query(nwk_file, samples=_meta.index, max_dist=_prune_threshold)
+    index = _meta.rows(names).astype(np.int32)
+    keep = _sample_id[index[i]] != _sample_id[index[j]]
+    a, b, dists = index[i[keep]], index[j[keep]], dists[keep]
+    return np.minimum(a, b), np.maximum(a, b), dists, np.unique(index[index >= 0])
+
+class PairAccumulator(object):
+    """Running per-pair sums across trees, keyed by the integer pair id i * n_samples + j (i < j).
+    Incoming tree results are buffered and folded into sorted key arrays once the buffer
+    outgrows them, so memory follows the number of distinct pairs, not pairs x trees.
+    Shared-tree counts are kept for every threshold, one column each.
+    With sample_id (the --prune mode, where trees only report their close pairs), the trees
+    observing a pair are instead counted from the rows present in each tree, once at the end."""
+    def __init__(self, n_samples, thresholds, buffer_size=1 << 20, sample_id=None):
+        self.n_samples, self.buffer_size, self.sample_id = n_samples, buffer_size, sample_id
+        self.thresholds = np.asarray(thresholds, dtype=np.float64)
+        self.keys = np.empty(0, dtype=np.int64)
+        self.observed = np.empty(0, dtype=np.int64)
+        self.shared = np.empty((0, len(self.thresholds)), dtype=np.int64)
+        self.dist_sum = np.empty(0)
+        self.dist_count = np.empty(0, dtype=np.int64)
+        self._pending, self._n_pending = [], 0
+        self._present = []
+
+    def add(self, idx1, idx2, dists, present=None):
+        if self.sample_id is not None:
+            self._present.append(np.asarray(present, dtype=np.int64))
+        self._pending.append((idx1.astype(np.int64) * self.n_samples + idx2, dists))
+        self._n_pending += len(dists)
+        if self._n_pending > max(self.buffer_size, len(self.keys)):
+            self._fold()
+
+    def _fold(self):
+        if not self._pending:
+            return
+        keys = np.concatenate([self.keys] + [k for k, d in self._pending])
+        dists = np.concatenate([d for k, d in self._pending])
+        known = ~np.isnan(dists)
+        uniq, inverse = np.unique(keys, return_inverse=True)
+        def total(old, new):
+            return np.bincount(inverse, weights=np.concatenate([old, new]), minlength=len(uniq))
+        self.observed = total(self.observed, np.ones(len(dists))).astype(np.int64)
+        self.shared = np.stack([total(self.shared[:, t], dists <= threshold) for t, threshold in enumerate(self.thresholds)], 1).astype(np.int64)
+        self.dist_sum = total(self.dist_sum, np.where(known, dists, 0.))
+        self.dist_count = total(self.dist_count, known).astype(np.int64)
+        self.keys = uniq
+        self._pending, self._n_pending = [], 0
+
+    def _observed_from_presence(self):
+        """Sorted pair ids observed together in at least one tree, with their number of trees:
+        the upper triangle of P^T P for the (trees x samples) presence matrix P, leaving out
+        pairs that share a Sample_ID"""
+        sizes = [len(rows) for rows in self._present]
+        rows = np.concatenate(self._present) if self._present else np.empty(0, dtype=np.int64)
+        presence = sp.csr_matrix((np.ones(len(rows), dtype=np.int64), (np.repeat(np.arange(len(sizes)), sizes), rows)),
+                                 shape=(len(sizes), self.n_samples))
+        together = sp.triu(presence.T @ presence, k=1, format='coo')
+        keep = self.sample_id[together.row] != self.sample_id[together.col]
+        keys = together.row[keep].astype(np.int64) * self.n_samples + together.col[keep]
+        order = np.argsort(keys)
+        return keys[order], together.data[keep][order].astype(np.int64)
+
+    def result(self):
+        """Sorted pair ids with their observed/shared tree counts and mean distances"""
+        self._fold()
+        if self.sample_id is not None and self._present:
+            # every reported pair was observed together, so its key is among the presence keys
+            keys, self.observed = self._observed_from_presence()
+            pos = np.searchsorted(keys, self.keys)
+            for name in ('shared', 'dist_sum', 'dist_count'):
+                values = getattr(self, name)
+                expanded = np.zeros((len(keys), ) + values.shape[1:], dtype=values.dtype)
+                expanded[pos] = values
+                setattr(self, name, expanded)
+            self.keys, self._present = keys, []
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean_distance = self.dist_sum / self.dist_count
+        return self.keys, self.observed, self.shared, np.where(self.dist_count > 0, mean_distance, np.nan)
 
 @click.command()
 @click.option("-m",'--metadata', required=True, help='Metadata file (TSV format)')
 @click.option("-t",'--tree_list', required=True, help='list of tree files (NWK format)')
 @click.option('--threshold', default=0.001, type=float, 
               help='Distance threshold for strain sharing')
+@click.option('--thresholds', default=None,
+              help='Comma-separated thresholds, all evaluated in one pass (one column set each)')
+@click.option('--threshold-grid', default=None,
+              help='Log-spaced thresholds as "min,max,n", combined with --thresholds')
+@click.option('--prune', is_flag=True, default=False,
+              help='Only measure pairs within the (largest) threshold; mean_distance is then averaged over sharing trees')
+@click.option('--tree-cache', envvar='FMT_TREE_CACHE', default=None,
+              help='Directory for the binary cache of parsed trees')
+@click.option('--distance-store', envvar='FMT_DISTANCE_STORE', default=None,
+              help='Directory of stored per-tree pair distances; trees already in it are not traversed again')
+@click.option('--checkpoint', default=None,
+              help='Directory of per-tree results; a rerun only processes new or changed trees and records failures in its manifest.tsv')
 @click.option("-o",'--output', required=True, help='Output file for pairwise results (TSV)')
 @click.option('--workers', default=8, type=int, 
               help='Number of parallel workers for processing trees')
-def main(metadata, tree_list, threshold, output, workers):
+def main(metadata, tree_list, threshold, thresholds, threshold_grid, prune, tree_cache, distance_store, checkpoint, output, workers):
     """
     Calculate strain sharing for each sample pair across multiple phylogenetic trees
     and categorize pairs using metadata.
     """
-    # Load metadata
-    meta_df = pd.read_csv(metadata, sep='\t').set_index('ID')
-    meta_df = meta_df[~meta_df.index.duplicated(keep='first')]
-    meta_dict = meta_df.to_dict(orient='index')
+    try:
+        thresholds = parse_thresholds(threshold, thresholds, threshold_grid)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    # Columns per threshold: unsuffixed for a single threshold, as before
+    suffixes = [''] if len(thresholds) == 1 else [f'_{t:g}' for t in thresholds]
+
+    # Load metadata, integer-encoded and sorted by ID
+    meta = load_metadata(metadata)
     
     # Get all NWK files
     with open(tree_list, 'r') as f:
@@ -118,69 +291,84 @@ def main(metadata, tree_list, threshold, output, workers):
     
     print(f"Found {len(nwk_files)} tree files for processing")
     
-    # Setup parallel processing
-    pool = multiprocessing.Pool(workers)
-    tasks = [(nwk_file, meta_dict, threshold) for nwk_file in nwk_files]
-    
-    # Process trees in parallel
-    all_results = []
-    with tqdm(total=len(tasks), desc="Processing trees") as pbar:
-        for tree_results in map(process_tree, tasks):
-            all_results.extend(tree_results)
-            pbar.update(1)
-    
-    # Convert to DataFrame
-    results_df = pd.DataFrame(all_results)
-    
-    # Add pair identifier (sorted)
-    results_df['pair'] = results_df.apply(
-        lambda row: tuple(sorted([row['sample1'], row['sample2']])), 
-        axis=1
-    )
-    
-    # Aggregate results across trees
-    agg_df = results_df.groupby('pair').agg(
-        sample1=('sample1', 'first'),
-        sample2=('sample2', 'first'),
-        trees_observed=('tree', 'count'),
-        trees_shared=('shared', 'sum'),
-        mean_distance=('distance', 'mean')
-    ).reset_index(drop=True)
-    
-    # Calculate sharing rate
-    agg_df['sharing_rate'] = agg_df['trees_shared'] / agg_df['trees_observed']
-    
-    # Add category
-    agg_df['category'] = agg_df.apply(
-        lambda row: categorize_pair(meta_dict[row['sample1']], meta_dict[row['sample2']]), 
-        axis=1
-    )
+    # Setup parallel processing: metadata is shipped once per worker through the initializer,
+    # and results stream back as soon as each tree finishes
+    sample_names = meta.ids.astype(object)
+    chunksize = max(1, min(16, len(nwk_files) // (max(workers, 1) * 4)))
+    prune_threshold = thresholds[-1] if prune else None
+    store = PairDistanceStore(distance_store, tree_cache) if distance_store else None
+    # A checkpoint holds metadata indices, so it is only valid for the same metadata and pruning
+    checkpoint_params = f'metadata={content_hash(metadata)};prune={prune_threshold!r}' if checkpoint else ''
+    initargs = (meta, prune_threshold, tree_cache, store, checkpoint, checkpoint_params)
+    if checkpoint:
+        os.makedirs(checkpoint, exist_ok=True)
+    # Process trees in parallel, folding each tree's pairs into the running per-pair sums
+    accumulator = PairAccumulator(len(sample_names), thresholds, sample_id=distinct_sample_ids(meta) if prune else None)
+    manifest, n_cached = [], 0
+    try:
+        with tree_pool(workers, init_worker, initargs) as imap, tqdm(total=len(nwk_files), desc="Processing trees") as pbar:
+            for nwk_file, key, idx1, idx2, dists, present, status, error, cached in imap(process_tree, nwk_files, chunksize=chunksize):
+                accumulator.add(idx1, idx2, dists, present)
+                manifest.append((nwk_file, key or '', status, error or ''))
+                n_cached += cached
+                pbar.update(1)
+    finally:
+        if checkpoint:
+            # Written even when interrupted; failed and unsaved trees are retried by the next run
+            pd.DataFrame(manifest, columns=['tree', 'key', 'status', 'error']).to_csv(
+                os.path.join(checkpoint, 'manifest.tsv'), sep='\t', index=False)
+
+    failed = [(nwk_file, error) for nwk_file, key, status, error in manifest if status == 'failed']
+    if checkpoint:
+        print(f"Reused {n_cached} checkpointed trees")
+    if failed:
+        print(f"Skipped {len(failed)} trees that could not be processed:")
+        for nwk_file, error in failed:
+            print(f"  {nwk_file}\t{error}")
+    unsaved = [(nwk_file, error) for nwk_file, key, status, error in manifest if status == 'unsaved']
+    if unsaved:
+        print(f"Could not checkpoint {len(unsaved)} trees (counted in this run):")
+        for nwk_file, error in unsaved:
+            print(f"  {nwk_file}\t{error}")
+
+    # Pairs are (i, j) with i < j in the metadata rows, sorted by ID, so sample1 < sample2 as before
+    keys, trees_observed, trees_shared, mean_distance = accumulator.result()
+    idx1, idx2 = keys // len(sample_names), keys % len(sample_names)
+    agg_df = pd.DataFrame({
+        'sample1': sample_names[idx1],
+        'sample2': sample_names[idx2],
+        'trees_observed': trees_observed,
+        'mean_distance': mean_distance,
+    })
     
-    # Add donor and individual information
-    def get_meta_info(row, field):
-        return '|'.join(sorted([meta_dict[row['sample1']].get(field, ''), meta_dict[row['sample2']].get(field, '')]))
+    # Calculate sharing rate for every threshold
+    for t, suffix in enumerate(suffixes):
+        agg_df['trees_shared' + suffix] = trees_shared[:, t]
+        agg_df['sharing_rate' + suffix] = trees_shared[:, t] / trees_observed
     
+    # Add category, and donor and individual information, on whole arrays of pairs
+    agg_df['category'] = np.array(CATEGORIES, dtype=object)[categorize_pairs(encode_metadata(meta), idx1, idx2)]
     for field in ['donor', 'individual', 'Disease type']:
-        agg_df[field] = agg_df.apply(lambda row: get_meta_info(row, field), axis=1)
+        agg_df[field] = pair_labels(meta.column(field), idx1, idx2)
     
     # Reorder columns
     final_df = agg_df[[
         'sample1', 'sample2', 'category', 
         'donor', 'individual', 'Disease type',
-        'trees_observed', 'trees_shared', 
-        'sharing_rate', 'mean_distance'
+        'trees_observed'] + [col + suffix for suffix in suffixes for col in ('trees_shared', 'sharing_rate')] + [
+        'mean_distance'
     ]]
     
     # Save results
     final_df.to_csv(output, sep='\t', index=False)
-    print(f"Processed {len(nwk_files)} trees")
+    print(f"Processed {len(nwk_files) - len(failed)} trees")
     print(f"Saved pairwise strain sharing results to {output}")
     
     # Print summary statistics
     print("\nSummary statistics by category:")
     summary = final_df.groupby('category').agg(
-        pairs=('sharing_rate', 'count'),
-        mean_sharing_rate=('sharing_rate', 'mean'),
+        pairs=('trees_observed', 'count'),
+        **{'mean_sharing_rate' + suffix: ('sharing_rate' + suffix, 'mean') for suffix in suffixes},
         mean_distance=('mean_distance', 'mean')
     ).reset_index()
     print(summary.to_string(index=False))
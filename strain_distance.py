@@ -0,0 +1,120 @@
+import os, hashlib
+import numpy as np
+from nwk_tree import load_tree
+from atomic_write import atomic_write
+
+# Bump when the stored pair distances change meaning, e.g. the leaf length scaling
+STORE_VERSION = 2
+
+
+def parse_thresholds(threshold, thresholds=None, grid=None):
+    """Distance thresholds to evaluate, sorted: a comma-separated list ('0.0005,0.001'),
+    a log-spaced grid ('min,max,n'), both, or else the single default threshold"""
+    values = []
+    if thresholds:
+        values += [float(t) for t in thresholds.split(',') if t.strip()]
+    if grid:
+        parts = grid.split(',')
+        if len(parts) != 3:
+            raise ValueError(f'threshold grid must be "min,max,n", got "{grid}"')
+        low, high, n = float(parts[0]), float(parts[1]), int(parts[2])
+        if n < 1 or low <= 0 or low > high:
+            raise ValueError(f'threshold grid needs 0 < min <= max and n >= 1, got "{grid}"')
+        values += np.geomspace(low, high, n).tolist()
+    return sorted(set(values)) if values else [threshold]
+
+
+def content_hash(path, extra=''):
+    """sha1 of a file's content, plus an optional string of parameters"""
+    h = hashlib.sha1()
+    with open(path, 'rb') as fin:
+        for block in iter(lambda: fin.read(1 << 20), b''):
+            h.update(block)
+    h.update(extra.encode())
+    return h.hexdigest()
+
+
+def sample_pair_distances(tre):
+    """Minimum tip-to-tip distance for every pair of distinct samples in an NwkTree,
+    independent of any metadata. Every named leaf is kept under its sample field, as in
+    get_distance, and reference genomes are left to the metadata filter of a query.
+    Returns (names, i, j, dist): the sorted sample names of the tree and the pairs i < j
+    indexing them, sorted by (i, j)."""
+    leaf = tre.size == 1
+    is_sample = leaf & (tre.samples != '')
+    names, codes = np.unique(tre.samples[is_sample], return_inverse=True)
+    node_code = np.full(len(leaf), -1, dtype=np.int64)
+    node_code[is_sample] = codes.reshape(-1)
+    k = len(names)
+
+    pairs = {}
+    leaf_len, dist, node_code = tre.leaf_lengths().tolist(), tre.dist.tolist(), node_code.tolist()
+    ptr, cidx = tre.child_ptr.tolist(), tre.child_idx.tolist()
+    d = [None] * len(leaf_len)
+    for n in tre.postorder.tolist():
+        if ptr[n] == ptr[n+1]:
+            d[n] = {node_code[n]: leaf_len[n]} if node_code[n] >= 0 else {}
+        else:
+            children = cidx[ptr[n]:ptr[n+1]]
+            for i, c1 in enumerate(children):
+                for c2 in children[:i]:
+                    for s1, d1 in d[c1].items():
+                        for s2, d2 in d[c2].items():
+                            if s1 != s2:
+                                key = s1 * k + s2 if s1 < s2 else s2 * k + s1
+                                if key not in pairs or pairs[key] > d1 + d2:
+                                    pairs[key] = d1 + d2
+            depths = {}
+            for c in children:
+                for s, depth in d[c].items():
+                    if s not in depths or depths[s] > depth + dist[n]:
+                        depths[s] = depth + dist[n]
+                d[c] = None
+            d[n] = depths
+
+    keys = np.fromiter(pairs.keys(), dtype=np.int64, count=len(pairs))
+    dists = np.fromiter(pairs.values(), dtype=np.float64, count=len(pairs))
+    order = np.argsort(keys)
+    keys, dists = keys[order], dists[order]
+    return names, (keys // max(k, 1)).astype(np.int32), (keys % max(k, 1)).astype(np.int32), dists
+
+
+class PairDistanceStore(object):
+    """On-disk store of the sample pair distances of trees (sample_pair_distances),
+    one .npz per tree under the sha1 of its Newick content, partitioned by the first two
+    hex digits. Entries are computed on first use; since they do not depend on metadata,
+    thresholds or categories, a re-analysis only reads them back."""
+    def __init__(self, root, tree_cache=None):
+        self.root, self.tree_cache = root, tree_cache
+
+    def key(self, nwk):
+        return content_hash(nwk, f'pairs-v{STORE_VERSION}')
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key + '.npz')
+
+    def load(self, nwk):
+        """(names, i, j, dist) of a tree, from the store or computed and stored"""
+        entry = self.path(self.key(nwk))
+        if os.path.isfile(entry):
+            try:
+                with np.load(entry) as data:
+                    return data['names'], data['i'], data['j'], data['dist']
+            except (OSError, ValueError, KeyError):
+                pass
+        names, i, j, dist = sample_pair_distances(load_tree(nwk, self.tree_cache))
+        # a read-only store still returns the distances
+        atomic_write(entry, lambda fout: np.savez(fout, names=names, i=i, j=j, dist=dist))
+        return names, i, j, dist
+
+    def query(self, nwk, samples=None, max_dist=None):
+        """Pairs of a tree restricted to samples (any container of names) and/or to
+        dist <= max_dist. Returns (names, i, j, dist) like load, names unfiltered."""
+        names, i, j, dist = self.load(nwk)
+        keep = np.ones(len(dist), dtype=bool)
+        if samples is not None:
+            wanted = np.array([s in samples for s in names.tolist()], dtype=bool)
+            keep &= wanted[i] & wanted[j]
+        if max_dist is not None:
+            keep &= dist <= max_dist
+        return names, i[keep], j[keep], dist[keep]
@@ -0,0 +1,31 @@
+import os
+from atomic_write import atomic_write
+
+
+def test_atomic_write_file(tmp_path):
+    path = str(tmp_path / 'sub' / 'entry.bin')
+    assert atomic_write(path, lambda f: f.write(b'abc')) is None
+    assert open(path, 'rb').read() == b'abc'
+    assert os.listdir(tmp_path / 'sub') == ['entry.bin']
+
+
+def test_atomic_write_directory(tmp_path):
+    path = str(tmp_path / 'entry')
+    assert atomic_write(path, lambda d: open(os.path.join(d, 'a.txt'), 'w').close(), directory=True) is None
+    assert os.listdir(path) == ['a.txt']
+    # the entry exists, so a second writer's rename fails and its tmp directory is removed
+    assert isinstance(atomic_write(path, lambda d: open(os.path.join(d, 'b.txt'), 'w').close(), directory=True), OSError)
+    assert os.listdir(tmp_path) == ['entry'] and os.listdir(path) == ['a.txt']
+
+
+def test_atomic_write_error_is_returned_and_cleaned_up(tmp_path):
+    def write(f):
+        f.write(b'partial')
+        raise OSError(28, 'No space left on device')
+    error = atomic_write(str(tmp_path / 'entry.bin'), write)
+    assert isinstance(error, OSError) and error.errno == 28
+    assert os.listdir(tmp_path) == []
+    # an unwritable location
+    blocker = tmp_path / 'file'
+    blocker.write_bytes(b'')
+    assert isinstance(atomic_write(str(blocker / 'entry.bin'), lambda f: f.write(b'abc')), OSError)
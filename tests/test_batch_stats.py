@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+from batch_stats import cmh_pvalues
+
+StratifiedTable = pytest.importorskip('statsmodels.stats.contingency_tables').StratifiedTable
+
+
+def statsmodels_pvalue(strata):
+    """The p-value as get_optimal_cut computed it before batch_stats: empty strata dropped,
+    StratifiedTable(shift_zeros=True).test_null_odds(), 1 without any stratum"""
+    strata = [t.tolist() for t in strata if t.sum() > 0]
+    if not strata:
+        return 1.
+    return StratifiedTable(strata, shift_zeros=True).test_null_odds().pvalue
+
+
+def test_cmh_pvalues_match_statsmodels():
+    rng = np.random.default_rng(0)
+    # small counts, so that zero cells and empty strata are common
+    tables = rng.integers(0, 6, size=(2000, 4, 2, 2)) * (rng.random((2000, 4, 1, 1)) < 0.8)
+    _, pvalues = cmh_pvalues(tables)
+    expected = np.array([statsmodels_pvalue(t) for t in tables])
+    np.testing.assert_allclose(pvalues, expected, rtol=1e-12, atol=0)
+
+
+def test_cmh_pvalues_shape_and_empty():
+    tables = np.zeros((3, 5, 4, 2, 2))
+    tables[0, 1, 2] = [[3, 1], [0, 4]]
+    statistics, pvalues = cmh_pvalues(tables)
+    assert pvalues.shape == statistics.shape == (3, 5)
+    assert pvalues[0, 1] == pytest.approx(statsmodels_pvalue(tables[0, 1]), rel=1e-12)
+    assert pvalues[1, 0] == 1. and statistics[1, 0] == 0.
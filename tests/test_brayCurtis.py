@@ -0,0 +1,134 @@
+import itertools, json
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import sparse as sp
+from scipy.spatial.distance import braycurtis
+from brayCurtis import read_profile, distance_blocks, TsvWriter, NpyWriter, ParquetWriter, SummaryWriter
+from pair_category import CATEGORIES
+
+HEADER = '#Species(RPKM)\t/data/S1/profile.txt\t/data/S2/profile.txt\t#Taxonomy\n'
+ROWS = ['sp A\t2\t1.5\t0\td__Bacteria;p__X;s__sp A strain 1\n',
+        'phage\t1\t0\t3\td__Viruses;p__V;s__Some phage\n',
+        'sp B\t1\t0\t2.5\td__Bacteria;p__X;s__sp B\n']
+
+
+def write(tmp_path, rows):
+    path = tmp_path / 'profile.tsv'
+    path.write_text(HEADER + ''.join(rows))
+    return str(path)
+
+
+@pytest.mark.parametrize('layout', ['dense', 'sparse', 'auto'])
+def test_read_profile_tab_fields(tmp_path, layout):
+    # names and taxonomies with spaces stay single fields, so viruses are still dropped
+    X, samples, species = read_profile(write(tmp_path, ROWS), layout=layout)
+    X = X.toarray() if hasattr(X, 'toarray') else np.asarray(X)
+    assert samples == ['S1', 'S2']
+    assert species == ['sp A', 'sp B']
+    assert X.tolist() == [[1.5, 0.], [0., 2.5]]
+
+
+@pytest.mark.parametrize('row', ['sp C\t1\t1\t2\td__Bacteria\textra\n', 'sp C\t1\t1\t2\n'])
+def test_read_profile_rejects_malformed_rows(tmp_path, row):
+    with pytest.raises(ValueError):
+        read_profile(write(tmp_path, ROWS + [row]))
+
+
+def test_read_profile_header_only(tmp_path):
+    X, samples, species = read_profile(write(tmp_path, []))
+    assert X.shape == (2, 0) and species == []
+
+
+def test_read_profile_auto_layout_from_first_chunk(tmp_path):
+    zeros = [f'sp {k}\t0\t0\t0\td__Bacteria;s__sp {k}\n' for k in range(6)]
+    path = write(tmp_path, ROWS + zeros)
+    dense, _, _ = read_profile(path, layout='dense')
+    # the first chunk (half its kept values non-zero) is dense, the whole profile is not
+    X, _, _ = read_profile(path, layout='auto', density_cutoff=0.5, chunksize=3)
+    assert isinstance(X, np.ndarray) and np.array_equal(X, dense)
+    X, _, _ = read_profile(write(tmp_path, zeros + ROWS), layout='auto', density_cutoff=0.5, chunksize=3)
+    assert hasattr(X, 'toarray') and X.shape == dense.shape and X.nnz == 2
+
+
+@pytest.mark.parametrize('density', [0.02, 0.3, 1.])
+def test_sparse_braycurtis_matches_scipy(density):
+    rng = np.random.default_rng(int(density * 100))
+    X = np.where(rng.random((23, 40)) < density, rng.lognormal(1., 1.5, (23, 40)), 0.)
+    X[5] = 0.
+    X[6] = X[7]
+    # small blocks, so rows are compared across blocks too
+    blocks = list(distance_blocks(sp.csr_matrix(X), ('braycurtis', ), block_size=4))
+    i = np.concatenate([b[0] for b in blocks])
+    j = np.concatenate([b[1] for b in blocks])
+    dists = np.concatenate([b[2]['braycurtis'] for b in blocks])
+    assert list(zip(i.tolist(), j.tolist())) == list(itertools.combinations(range(len(X)), 2))
+    with np.errstate(invalid='ignore'):
+        expected = [braycurtis(X[a], X[b]) for a, b in zip(i.tolist(), j.tolist())]
+    assert np.allclose(dists, expected, rtol=1e-12, atol=1e-12, equal_nan=True)
+
+
+def write_pairs(writer_class, output, *args):
+    """Random distances (with NaN) and categories of every pair of 9 samples, written in blocks
+    as brayCurtis.py does; returns the pairs as a DataFrame"""
+    rng = np.random.default_rng(5)
+    samples = np.array([f'S{k}' for k in range(9)], dtype=object)
+    i, j = map(np.array, zip(*itertools.combinations(range(len(samples)), 2)))
+    expected = pd.DataFrame({'Sample1': samples[i], 'Sample2': samples[j], 'BrayCurtis': rng.random(len(i)),
+                             'Jaccard': rng.random(len(i)), 'Category': rng.integers(len(CATEGORIES), size=len(i)).astype(np.int8)})
+    expected.loc[[3, 20], 'BrayCurtis'] = np.nan
+    writer = writer_class(output, samples, ['BrayCurtis', 'Jaccard'], *args)
+    for start in range(0, len(i), 10):
+        block = slice(start, start + 10)
+        writer.write(i[block], j[block], expected['Category'].to_numpy()[block],
+                     {c: expected[c].to_numpy()[block] for c in ('BrayCurtis', 'Jaccard')})
+    writer.close()
+    return expected.assign(Category=np.array(CATEGORIES, dtype=object)[expected['Category']])
+
+
+def test_tsv_writer_round_trip(tmp_path):
+    output = str(tmp_path / 'd.tsv')
+    expected = write_pairs(TsvWriter, output)
+    result = pd.read_csv(output, sep='\t', float_precision='round_trip')
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+
+def test_npy_writer_round_trip(tmp_path):
+    output = str(tmp_path / 'd.npy')
+    expected = write_pairs(NpyWriter, output)
+    with open(str(tmp_path / 'd.index.json')) as f:
+        index = json.load(f)
+    i, j = map(list, zip(*itertools.combinations(range(len(index['samples'])), 2)))
+    assert np.array(index['samples'])[i].tolist() == expected['Sample1'].tolist()
+    assert np.array(index['samples'])[j].tolist() == expected['Sample2'].tolist()
+    for column, path in index['columns'].items():
+        np.testing.assert_array_equal(np.load(path), expected[column].to_numpy())
+    category = np.load(str(tmp_path / 'd.category.npy'))
+    assert np.array(index['categories'])[category].tolist() == expected['Category'].tolist()
+
+
+def test_parquet_writer_round_trip(tmp_path):
+    pq = pytest.importorskip('pyarrow.parquet')
+    output = str(tmp_path / 'd.parquet')
+    expected = write_pairs(ParquetWriter, output)
+    table = pq.read_table(output)
+    assert table.num_rows == len(expected) and pq.ParquetFile(output).num_row_groups == 4
+    result = table.to_pandas()
+    for column in ('Sample1', 'Sample2', 'Category'):
+        result[column] = result[column].astype(object)
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+
+def test_summary_writer_statistics(tmp_path):
+    output = str(tmp_path / 'd.tsv')
+    expected = write_pairs(SummaryWriter, output, {'BrayCurtis': (0., 1.), 'Jaccard': (0., 1.)}, 50)
+    summary = pd.read_csv(output, sep='\t', float_precision='round_trip')
+    for (category, metric), row in summary.set_index(['category', 'metric']).iterrows():
+        values = expected.loc[expected['Category'] == category, metric].dropna()
+        assert row['pairs'] == len(values)
+        assert np.isclose(row['mean'], values.mean()) and row['min'] == values.min() and row['max'] == values.max()
+        # quantiles are interpolated from the histogram, within the observed range
+        quantiles = row[['2.5%', '25%', 'median', '75%', '97.5%']].to_numpy(dtype=float)
+        assert np.all(np.diff(quantiles) >= 0) and values.min() <= quantiles[0] and quantiles[-1] <= values.max()
+    hist = pd.read_csv(output + '.hist.tsv', sep='\t')
+    assert hist.groupby(['category', 'metric'])['pairs'].sum().sort_index().tolist() == summary.set_index(['category', 'metric'])['pairs'].sort_index().tolist()
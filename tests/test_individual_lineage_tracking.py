@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+from benchmark import synthetic_metadata, synthetic_newick
+from nwk_tree import parse_newick
+from sample_metadata import Metadata
+from individual_lineage_tracking import c_codes, h_codes, sample_keys, count_tables
+
+
+def brute_force_counts(tre, meta):
+    """Per node: tips with a key inside, and the (cohort x health) counts of distinct keys with
+    a tip inside / outside, from the explicit tip sets"""
+    keys = sample_keys(meta, tre.samples)
+    tips = [t for t in tre.leaves().tolist() if keys[t] >= 0]
+    n_tips = np.zeros(len(tre), dtype=np.int64)
+    in_cnt = np.zeros((len(tre), len(c_codes), len(h_codes)), dtype=np.int64)
+    out_cnt = np.zeros_like(in_cnt)
+    for n in range(len(tre)):
+        inside = [t for t in tips if n <= t < n + tre.size[n]]
+        n_tips[n] = len(inside)
+        for cnt, group in ((in_cnt, inside), (out_cnt, set(tips) - set(inside))):
+            for key in {int(keys[t]) for t in group}:
+                cnt[n, key // len(h_codes) % len(c_codes), key % len(h_codes)] += 1
+    return tips, n_tips, in_cnt, out_cnt
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_count_tables_matches_brute_force(seed):
+    rng = np.random.default_rng(seed)
+    frame = synthetic_metadata(60, rng)
+    tre = parse_newick(synthetic_newick(frame, 200, rng))
+    # keys are dropped for an unknown cohort or disease type, or a missing individual
+    frame.loc[frame.index[::11], 'Cohort'] = 'other'
+    frame.loc[frame.index[3::13], 'Disease type'] = 'unknown'
+    frame.loc[frame.index[5::17], 'individual'] = np.nan
+    meta = Metadata.from_frame(frame)
+    expected = brute_force_counts(tre, meta)
+    tips, n_tips, in_cnt, out_cnt = count_tables(tre, meta)
+    assert tips == expected[0]
+    assert np.array_equal(n_tips, expected[1])
+    assert np.array_equal(in_cnt, expected[2])
+    assert np.array_equal(out_cnt, expected[3])
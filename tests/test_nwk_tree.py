@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+from nwk_tree import parse_newick
+
+ete3 = pytest.importorskip('ete3')
+
+TREES = [
+    # leaf names with '|' fields and low_qual, named internal node
+    "((A|c1:0.1,B|c2|low_qual:0.2)N1:0.3,C|c3:0.4);",
+    # unnamed internal nodes, named root, missing lengths
+    "((A:0.1,B:0.2):0.3,(C,D):0.4)root;",
+    "((A,B),(C,(D,E)));",
+    # quoted names, with a space and without a length
+    "(('a b|x':0.1,'c':0.2)n:0.3,'d e');",
+    # NHX comments
+    "((A:0.1[&&NHX:S=human],B:0.2[&&NHX:S=mouse])N1:0.3[&&NHX:D=N],C:0.4);",
+    # exponents, root length, polytomy
+    "(A:1e-3,B:2.5E-2,(C:1,D:2,E:3)F:4)R:0.5;",
+    # single node
+    "A;",
+]
+
+
+def ete3_arrays(text):
+    """Preorder names, branch lengths and parent indices of ete3's parse (format=1, as the
+    scripts used before nwk_tree)"""
+    nodes = list(ete3.Tree(text, format=1).traverse('preorder'))
+    index = {id(node): k for k, node in enumerate(nodes)}
+    parent = [index[id(node.up)] if node.up is not None else -1 for node in nodes]
+    return [node.name for node in nodes], [node.dist for node in nodes], parent
+
+
+@pytest.mark.parametrize('text', TREES)
+def test_parse_newick_matches_ete3(text):
+    tre = parse_newick(text)
+    names, dist, parent = ete3_arrays(text)
+    assert tre.names.tolist() == names
+    assert tre.dist.tolist() == dist
+    assert tre.parent.tolist() == parent
+
+
+@pytest.mark.parametrize('text', TREES)
+def test_parse_newick_structure(text):
+    tre = parse_newick(text)
+    n = len(tre)
+    # subtree sizes, children and postorder are consistent with the parents
+    for i in range(n):
+        children = tre.children(i).tolist()
+        assert children == [k for k in range(n) if tre.parent[k] == i]
+        assert tre.size[i] == 1 + sum(tre.size[c] for c in children)
+    position = {node: k for k, node in enumerate(tre.postorder.tolist())}
+    assert sorted(position) == list(range(n))
+    assert all(position[k] < position[tre.parent[k]] for k in range(1, n))
+
+
+def test_parse_newick_samples():
+    tre = parse_newick(TREES[0])
+    leaves = tre.leaves().tolist()
+    assert tre.samples[leaves].tolist() == ['A', 'B', 'C']
+    assert tre.low_qual[leaves].tolist() == [False, True, False]
+    assert np.allclose(tre.leaf_lengths()[leaves], [0.025, 0.2, 0.1])
+
+
+@pytest.mark.parametrize('text', ["((A,B);", "(A,B));", "(A,,B);"])
+def test_parse_newick_malformed(text):
+    with pytest.raises(ValueError):
+        parse_newick(text)
@@ -0,0 +1,38 @@
+import numpy as np
+import pandas as pd
+from pair_category import CATEGORIES, categorize_pair, categorize_pairs, encode_metadata
+from sample_metadata import Metadata
+
+
+def random_metadata(n, rng):
+    """Metadata with overlapping individuals and donors, and some missing values"""
+    people = [f'P{k}' for k in range(6)]
+    types = ['healthy', 'before_FMT', 'responder', 'non-responder', 'other', np.nan]
+    meta = pd.DataFrame({
+        'ID': [f'S{k:03d}' for k in range(n)],
+        'individual': rng.choice(people + [np.nan], n).tolist(),
+        'donor': rng.choice(people + [np.nan], n).tolist(),
+        'Disease type': [types[k] for k in rng.integers(len(types), size=n)],
+    })
+    return meta.astype(object).where(meta.notna(), np.nan)
+
+
+def test_categorize_pairs_matches_categorize_pair():
+    rng = np.random.default_rng(1)
+    frame = random_metadata(120, rng)
+    meta = Metadata.from_frame(frame)
+    i, j = np.triu_indices(len(meta), k=1)
+    codes = categorize_pairs(encode_metadata(meta), i, j)
+
+    rows = frame.set_index('ID').loc[meta.ids.tolist()].to_dict('records')
+    expected = [categorize_pair(rows[a], rows[b]) for a, b in zip(i.tolist(), j.tolist())]
+    assert np.array(CATEGORIES)[codes].tolist() == expected
+
+
+def test_encode_metadata_rows():
+    frame = random_metadata(30, np.random.default_rng(2))
+    meta = Metadata.from_frame(frame)
+    rows = np.array([5, 0, 17])
+    full, subset = encode_metadata(meta), encode_metadata(meta, rows)
+    for key in full:
+        assert subset[key].tolist() == full[key][rows].tolist()
@@ -0,0 +1,27 @@
+import numpy as np
+import pytest
+from roc import delong
+
+
+def brute_force(status, score):
+    """AUC and DeLong variance from the pairwise placement values (DeLong et al., 1988)"""
+    pos, neg = score[status == 1], score[status == 0]
+    psi = (pos[:, None] > neg[None, :]) + 0.5 * (pos[:, None] == neg[None, :])
+    v10, v01 = psi.mean(1), psi.mean(0)
+    return psi.mean(), v10.var(ddof=1) / len(pos) + v01.var(ddof=1) / len(neg)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_delong_matches_brute_force(seed):
+    rng = np.random.default_rng(seed)
+    status = rng.integers(0, 2, 80)
+    # rounded scores, so that there are ties
+    score = np.round(rng.random(80) + 0.3 * status, 1)
+    auc_value, var = delong(status, score)
+    expected_auc, expected_var = brute_force(status, score)
+    assert auc_value == pytest.approx(expected_auc, rel=1e-12)
+    assert var == pytest.approx(expected_var, rel=1e-10)
+
+
+def test_delong_single_class():
+    assert all(np.isnan(delong(np.ones(5, dtype=int), np.arange(5.))))
@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+from benchmark import synthetic_metadata, synthetic_newick
+from nwk_tree import parse_newick
+from sample_metadata import Metadata
+from strainSharing import distinct_sample_ids, get_distance, get_close_pairs, pair_arrays, PairAccumulator
+
+
+def synthetic_case(seed, n_samples=40, n_tips=300, n_trees=1):
+    """Metadata and random strain trees; some samples share a Sample_ID or have none"""
+    rng = np.random.default_rng(seed)
+    frame = synthetic_metadata(n_samples, rng)
+    frame['Sample_ID'] = [np.nan if k % 9 == 8 else f'X{k - k % 2 if k % 6 < 2 else k}' for k in range(n_samples)]
+    trees = [parse_newick(synthetic_newick(frame, n_tips, rng)) for _ in range(n_trees)]
+    return Metadata.from_frame(frame), trees
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_get_close_pairs_matches_get_distance(seed):
+    meta, [tre] = synthetic_case(seed)
+    full = get_distance(tre, meta)
+    values = sorted(full.values())
+    # thresholds equal to a pair distance check that the bound is inclusive
+    for threshold in (0., values[len(values) // 10], values[len(values) // 2], values[-1]):
+        close, present = get_close_pairs(tre, meta, threshold)
+        assert close == {pair: d for pair, d in full.items() if d <= threshold}
+    rows = meta.rows(tre.samples[tre.size == 1])
+    assert present == set(rows[rows >= 0].tolist())
+
+
+def test_get_close_pairs_zero_length_branches():
+    meta, _ = synthetic_case(0)
+    a, b, c = meta.ids[2:5].tolist()
+    tre = parse_newick(f'(({a}|x|low_qual:0,{b}|y|low_qual:0):0,({c}|z:0.004,GCF_000000001.1:0):0.002);')
+    full = get_distance(tre, meta)
+    for threshold in (0., 0.003, 0.01):
+        assert get_close_pairs(tre, meta, threshold)[0] == {pair: d for pair, d in full.items() if d <= threshold}
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_pair_accumulator_pruned_matches_unpruned(seed):
+    # small trees, so pairs are observed together in different numbers of trees
+    meta, trees = synthetic_case(seed, n_tips=50, n_trees=8)
+    dists = np.concatenate([list(get_distance(tre, meta).values()) for tre in trees])
+    thresholds = np.quantile(dists, [0.05, 0.2, 0.5]).tolist()
+    # a small buffer folds several times along the way
+    full = PairAccumulator(len(meta), thresholds, buffer_size=500)
+    pruned = PairAccumulator(len(meta), thresholds, buffer_size=500, sample_id=distinct_sample_ids(meta))
+    close_sums = {}
+    for tre in trees:
+        full.add(*pair_arrays(get_distance(tre, meta)))
+        close, present = get_close_pairs(tre, meta, thresholds[-1])
+        pruned.add(*pair_arrays(close), np.array(sorted(present), dtype=np.int32))
+        for (i, j), d in close.items():
+            close_sums.setdefault(i * len(meta) + j, []).append(d)
+
+    keys, observed, shared, mean_distance = full.result()
+    p_keys, p_observed, p_shared, p_mean_distance = pruned.result()
+    assert np.array_equal(keys, p_keys)
+    assert np.array_equal(observed, p_observed)
+    assert np.array_equal(shared, p_shared)
+    # under pruning the mean only covers the trees sharing the pair
+    expected = np.array([np.mean(close_sums[k]) if k in close_sums else np.nan for k in keys.tolist()])
+    assert np.allclose(p_mean_distance, expected, equal_nan=True)
@@ -0,0 +1,16 @@
+import numpy as np
+import pytest
+from strain_distance import parse_thresholds
+
+
+def test_parse_thresholds():
+    assert parse_thresholds(0.001) == [0.001]
+    assert parse_thresholds(0.001, '0.002,0.0005,0.002') == [0.0005, 0.002]
+    grid = parse_thresholds(0.001, '0.003', '0.0001,0.01,3')
+    assert np.allclose(grid, [0.0001, 0.001, 0.003, 0.01])
+
+
+@pytest.mark.parametrize('grid', ['0.001,0.01', '0.001,0.01,0', '0.001,0.01,-2', '0,0.01,3', '0.01,0.001,3'])
+def test_parse_thresholds_rejects_bad_grids(grid):
+    with pytest.raises(ValueError):
+        parse_thresholds(0.001, None, grid)
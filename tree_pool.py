@@ -0,0 +1,25 @@
+import contextlib, multiprocessing
+
+@contextlib.contextmanager
+def tree_pool(workers, initializer, initargs=()):
+    """Pool of workers set up by initializer(*initargs), yielded as imap(func, items, ordered=False,
+    chunksize=1); with workers <= 1 the initializer and func run in this process instead.
+    On an error or Ctrl-C the pool is terminated, so the queued trees are not waited for."""
+    if workers <= 1:
+        initializer(*initargs)
+        yield lambda func, items, ordered=False, chunksize=1: map(func, items)
+        return
+
+    pool = multiprocessing.Pool(workers, initializer=initializer, initargs=initargs)
+
+    def imap(func, items, ordered=False, chunksize=1):
+        return (pool.imap if ordered else pool.imap_unordered)(func, items, chunksize=chunksize)
+
+    try:
+        yield imap
+    except BaseException:
+        pool.terminate()
+        pool.join()
+        raise
+    pool.close()
+    pool.join()